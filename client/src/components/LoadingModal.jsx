@@ -8,7 +8,13 @@ import {
   Fade,
 } from "@mui/material";
 
-const LoadingModal = ({ open, progress = 0, message = "Loading..." }) => {
+const LoadingModal = ({
+  open,
+  progress = 0,
+  message = "Loading...",
+  image = null,
+  preview = null,
+}) => {
   return (
     <Modal open={open} closeAfterTransition>
       <Fade in={open}>
@@ -30,6 +36,29 @@ const LoadingModal = ({ open, progress = 0, message = "Loading..." }) => {
             <Typography variant="h6" fontWeight={700} color="primary.main">
               {message}
             </Typography>
+            {image && preview && (
+              <Box sx={{ position: "relative", width: "100%" }}>
+                <Box
+                  component="img"
+                  src={image}
+                  alt="Image being segmented"
+                  sx={{ width: "100%", display: "block", borderRadius: 2 }}
+                />
+                <Box
+                  component="img"
+                  src={`data:image/png;base64,${preview}`}
+                  alt="Masks found so far"
+                  sx={{
+                    position: "absolute",
+                    inset: 0,
+                    width: "100%",
+                    height: "100%",
+                    opacity: 0.6,
+                    borderRadius: 2,
+                  }}
+                />
+              </Box>
+            )}
             <LinearProgress
               variant="determinate"
               value={progress}
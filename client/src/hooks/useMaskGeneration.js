@@ -1,10 +1,16 @@
-import { useState, useRef, useCallback } from "react";
+import { useState, useRef, useCallback, useEffect } from "react";
 import { toast } from "react-toastify";
 import {
-  generateMasksService,
+  generateMasksStreamService,
   getMaskAtPointsService,
-  applyColorsService,
+  createRenderSessionService,
+  addLayerService,
+  deleteLayerService,
+  undoLayerService,
+  redoLayerService,
+  exportRenderService,
 } from "../services/api";
+import { compositeFromRle } from "../utils/maskCodec";
 
 const useMaskGeneration = () => {
   const [isGenerating, setIsGenerating] = useState(false);
@@ -15,26 +21,69 @@ const useMaskGeneration = () => {
   const [selectedMasks, setSelectedMasks] = useState([]);
   const [currentPoints, setCurrentPoints] = useState([]);
   const [currentColor, setCurrentColor] = useState("#4A90E2");
+  const [blendMode, setBlendMode] = useState("flat");
   const [coloredImage, setColoredImage] = useState(null);
+  const [sessionId, setSessionId] = useState(null);
   const [colorHistory, setColorHistory] = useState([]);
+  const [redoHistory, setRedoHistory] = useState([]);
   const [masksGenerated, setMasksGenerated] = useState(false);
 
   const imageRef = useRef(null);
 
-  const generateMasks = useCallback(async (filename, imageUrl) => {
+  // onProgress({ crop, crops, preview }) is called as each image crop is
+  // done, with a composite of the (not yet deduplicated) masks found so far
+  const generateMasks = useCallback(async (filename, imageUrl, onProgress) => {
     setIsGenerating(true);
     setError(null);
 
     try {
-      const response = await generateMasksService(filename);
+      const found = [];
+      const crops = [];
+      let result = null;
+      await generateMasksStreamService(filename, (event) => {
+        if (event.event === "error") {
+          throw new Error(event.error);
+        }
+        if (event.event === "done") {
+          result = event;
+          return;
+        }
+        crops[event.crop] = event.masks;
+        found.push(...event.masks);
+        const [height, width] = found[0]?.size || [0, 0];
+        onProgress?.({
+          crop: event.crop + 1,
+          crops: event.crops,
+          preview: found.length
+            ? compositeFromRle({ width, height, masks: found })
+            : null,
+        });
+      });
+      if (!result) {
+        throw new Error("Mask stream ended early");
+      }
 
-      setCompositeMask(response.data.composite_mask);
+      const [height, width] = result.image_size;
+      // Masks already streamed are referenced as [crop, index]
+      const masks = result.masks.map((mask, i) => ({
+        id: i,
+        score: mask.score,
+        counts: mask.ref ? crops[mask.ref[0]][mask.ref[1]].counts : mask.counts,
+        maskId: mask.mask_id,
+      }));
+      const data = {
+        masks,
+        composite_mask: compositeFromRle({ width, height, masks }),
+        image_size: [height, width],
+      };
+
+      setCompositeMask(data.composite_mask);
       setOriginalImage(imageUrl);
       setMasksGenerated(true);
       toast.success("Masks generated successfully");
-      return response.data;
+      return data;
     } catch (err) {
-      const errorMsg = err.response?.data?.error || "Failed to generate masks";
+      const errorMsg = err.message || "Failed to generate masks";
       setError(errorMsg);
       toast.error(errorMsg);
       throw err;
@@ -69,7 +118,7 @@ const useMaskGeneration = () => {
           return null;
         }
 
-        return response.data.mask;
+        return { mask: response.data.mask, maskId: response.data.mask_id };
       } catch (err) {
         console.error("API call failed:", err);
         const errorMsg = err.response?.data?.error || "Failed to get mask";
@@ -108,7 +157,7 @@ const useMaskGeneration = () => {
             setSelectedMasks([
               {
                 points: newPoints,
-                mask: combinedMask,
+                ...combinedMask,
               },
             ]);
             toast.info("Added to selection");
@@ -122,7 +171,7 @@ const useMaskGeneration = () => {
             setSelectedMasks([
               {
                 points: [point],
-                mask: mask,
+                ...mask,
               },
             ]);
             toast.info("New selection created");
@@ -141,91 +190,199 @@ const useMaskGeneration = () => {
     setCurrentPoints([]);
   }, []);
 
-  const applyColors = useCallback(
-    async (color) => {
-      if (!originalImage || selectedMasks.length === 0) return null;
-
-      try {
-        const operations = selectedMasks.map((mask) => ({
-          mask: mask.mask,
-          color: color,
-        }));
-
-        const requestData = {
-          filename: originalImage.split("/").pop(),
-          operations: operations,
-          previous_image: coloredImage,
-        };
-
-        const response = await applyColorsService(requestData);
+  // Paint layers live in a server-side render session, so applying, undoing
+  // or removing a colour only re-renders the pixels it covers
+  useEffect(() => {
+    if (!originalImage) return;
+    setSessionId(null);
+    createRenderSessionService(originalImage.split("/").pop())
+      .then((response) => setSessionId(response.data.session_id))
+      .catch((err) => console.error("Failed to start render session:", err));
+  }, [originalImage]);
+
+  // Starts a fresh session and replays the history into it, sending the mask
+  // pixels since mask handles may have expired along with the session
+  const replaySession = useCallback(
+    async (history) => {
+      let response = await createRenderSessionService(
+        originalImage.split("/").pop()
+      );
+      const id = response.data.session_id;
+      const entries = [];
+      for (const entry of history) {
+        const layerIds = [];
+        for (const mask of entry.masks) {
+          response = await addLayerService(id, {
+            mask: mask.mask,
+            color: entry.color,
+            blend_mode: entry.blendMode,
+          });
+          layerIds.push(response.data.layer_id);
+        }
+        entries.push({ ...entry, layerIds });
+      }
+      setSessionId(id);
+      return { id, data: response.data, entries };
+    },
+    [originalImage]
+  );
 
-        toast.success("Color applied successfully");
-        return response.data.colored_image;
-      } catch (err) {
-        const errorMsg = err.response?.data?.error || "Failed to apply color";
-        toast.error(errorMsg);
-        return null;
+  // Runs `edit` against the current session and shows its render. When there
+  // is no session, it expired (410) or it is out of step with the history
+  // (409, e.g. nothing to redo), the session is rebuilt from `history`.
+  const syncRender = useCallback(
+    async (history, edit) => {
+      let data = null;
+      let entries = history;
+      if (sessionId) {
+        try {
+          data = await edit(sessionId);
+        } catch (err) {
+          if (![409, 410].includes(err.response?.status)) throw err;
+        }
+      }
+      if (!data) {
+        ({ data, entries } = await replaySession(history));
       }
+      setColoredImage(data.layers.length ? data.colored_image : null);
+      setColorHistory(entries);
     },
-    [originalImage, selectedMasks, coloredImage]
+    [sessionId, replaySession]
   );
 
   const handleApplyColor = useCallback(async () => {
-    const result = await applyColors(currentColor);
-    if (result) {
-      setColoredImage(result);
-      setColorHistory((prev) => [
-        ...prev,
-        {
-          masks: selectedMasks,
-          color: currentColor,
-          image: result,
-        },
-      ]);
+    if (!originalImage || selectedMasks.length === 0) return;
+
+    const entry = {
+      masks: selectedMasks,
+      color: currentColor,
+      blendMode,
+      layerIds: [],
+    };
+    try {
+      await syncRender([...colorHistory, entry], async (id) => {
+        let data;
+        for (const mask of selectedMasks) {
+          // Refer to server-side masks by ID when we have them
+          const response = await addLayerService(id, {
+            ...(mask.maskId ? { mask_id: mask.maskId } : { mask: mask.mask }),
+            color: currentColor,
+            blend_mode: blendMode,
+          });
+          data = response.data;
+          entry.layerIds.push(data.layer_id);
+        }
+        return data;
+      });
+      setRedoHistory([]);
       clearSelection();
+      toast.success("Color applied successfully");
+    } catch (err) {
+      const errorMsg = err.response?.data?.error || "Failed to apply color";
+      toast.error(errorMsg);
     }
-  }, [applyColors, currentColor, selectedMasks, clearSelection]);
+  }, [
+    originalImage,
+    selectedMasks,
+    currentColor,
+    blendMode,
+    colorHistory,
+    syncRender,
+    clearSelection,
+  ]);
 
-  const handleDownload = useCallback(() => {
-    if (!coloredImage) {
+  // Previews are rendered on a downscaled working copy, the download is
+  // rendered by the server at the original resolution
+  const handleDownload = useCallback(async () => {
+    if (!coloredImage || !sessionId) {
       toast.error("No image to download");
       return;
     }
 
-    const link = document.createElement("a");
-    link.href = `data:image/png;base64,${coloredImage}`;
-    link.download = "colored-building.png";
-    document.body.appendChild(link);
-    link.click();
-    document.body.removeChild(link);
-    toast.success("Download started");
-  }, [coloredImage]);
-
-  const handleUndo = useCallback(() => {
-    if (colorHistory.length > 0) {
-      const newHistory = [...colorHistory];
-      newHistory.pop();
-      setColorHistory(newHistory);
-
-      setColoredImage(
-        newHistory.length > 0 ? newHistory[newHistory.length - 1].image : null
-      );
+    try {
+      let response;
+      try {
+        response = await exportRenderService(sessionId);
+      } catch (err) {
+        if (err.response?.status !== 410) throw err;
+        const { id, entries } = await replaySession(colorHistory);
+        setColorHistory(entries);
+        response = await exportRenderService(id);
+      }
+      const url = URL.createObjectURL(response.data);
+      const link = document.createElement("a");
+      link.href = url;
+      link.download = "colored-building.png";
+      document.body.appendChild(link);
+      link.click();
+      document.body.removeChild(link);
+      URL.revokeObjectURL(url);
+      toast.success("Download started");
+    } catch (err) {
+      console.error("Download failed:", err);
+      toast.error("Failed to download image");
+    }
+  }, [coloredImage, sessionId, colorHistory, replaySession]);
+
+  const handleUndo = useCallback(async () => {
+    if (colorHistory.length === 0) return;
 
+    const last = colorHistory[colorHistory.length - 1];
+    try {
+      await syncRender(colorHistory.slice(0, -1), async (id) => {
+        let response;
+        for (let i = 0; i < last.layerIds.length; i++) {
+          response = await undoLayerService(id);
+        }
+        return response.data;
+      });
+      setRedoHistory((prev) => [...prev, last]);
       toast.info("Undo last color application");
+    } catch (err) {
+      toast.error(err.response?.data?.error || "Failed to undo");
     }
-  }, [colorHistory]);
+  }, [colorHistory, syncRender]);
 
-  const removeColor = useCallback(
-    (index) => {
-      setColorHistory((prev) => prev.filter((_, i) => i !== index));
+  const handleRedo = useCallback(async () => {
+    if (redoHistory.length === 0) return;
 
-      if (coloredImage === colorHistory[index].image) {
-        setColoredImage(index > 0 ? colorHistory[index - 1].image : null);
-      }
+    const next = redoHistory[redoHistory.length - 1];
+    try {
+      await syncRender([...colorHistory, next], async (id) => {
+        let response;
+        for (let i = 0; i < next.layerIds.length; i++) {
+          response = await redoLayerService(id);
+        }
+        return response.data;
+      });
+      setRedoHistory((prev) => prev.slice(0, -1));
+      toast.info("Redo color application");
+    } catch (err) {
+      toast.error(err.response?.data?.error || "Failed to redo");
+    }
+  }, [colorHistory, redoHistory, syncRender]);
 
-      toast.info("Color removed from history");
+  const removeColor = useCallback(
+    async (index) => {
+      const removed = colorHistory[index];
+      try {
+        await syncRender(
+          colorHistory.filter((_, i) => i !== index),
+          async (id) => {
+            let response;
+            for (const layerId of removed.layerIds) {
+              response = await deleteLayerService(id, layerId);
+            }
+            return response.data;
+          }
+        );
+        setRedoHistory([]);
+        toast.info("Color removed from history");
+      } catch (err) {
+        toast.error(err.response?.data?.error || "Failed to remove color");
+      }
     },
-    [coloredImage, colorHistory]
+    [colorHistory, syncRender]
   );
 
   return {
@@ -236,8 +393,11 @@ const useMaskGeneration = () => {
     showAllMasks,
     currentColor,
     setCurrentColor,
+    blendMode,
+    setBlendMode,
     coloredImage,
     colorHistory,
+    canRedo: redoHistory.length > 0,
     selectedMasks,
     masksGenerated,
     generateMasks,
@@ -247,6 +407,7 @@ const useMaskGeneration = () => {
     handleApplyColor,
     handleDownload,
     handleUndo,
+    handleRedo,
     removeColor,
     setCompositeMask,
     setMasksGenerated,
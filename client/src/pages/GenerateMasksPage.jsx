@@ -12,6 +12,7 @@ const GenerateMasksPage = () => {
   const navigate = useNavigate();
   const { image } = location.state || {};
   const [progress, setProgress] = useState(0);
+  const [preview, setPreview] = useState(null);
   const [showModal, setShowModal] = useState(false);
 
   const {
@@ -34,20 +35,17 @@ const GenerateMasksPage = () => {
 
   const handleGenerate = async () => {
     setProgress(0);
+    setPreview(null);
     setShowModal(true);
 
-    const interval = setInterval(() => {
-      setProgress(prev => {
-        if (prev >= 90) {
-          clearInterval(interval);
-          return prev;
-        }
-        return prev + 10;
-      });
-    }, 500);
+    // Masks stream in per image crop; the final deduplicated set follows
+    const onProgress = ({ crop, crops, preview }) => {
+      setProgress(Math.round((crop / crops) * 90));
+      if (preview) setPreview(preview);
+    };
 
     try {
-      const masks = await generateMasks(image.filename, `${import.meta.env.VITE_API_BASE_URL}/${image.url}`);
+      const masks = await generateMasks(image.filename, `${import.meta.env.VITE_API_BASE_URL}/${image.url}`, onProgress);
       setProgress(100);
       setTimeout(() => {
         setShowModal(false);
@@ -55,11 +53,8 @@ const GenerateMasksPage = () => {
       }, 750);
     } catch (err) {
       console.error(err)
-      clearInterval(interval);
       setShowModal(false);
       toast.error('Failed to generate masks');
-    } finally {
-      clearInterval(interval);
     }
   };
 
@@ -151,6 +146,8 @@ const GenerateMasksPage = () => {
           open={showModal}
           progress={progress}
           message="Generating masks..."
+          image={`${import.meta.env.VITE_API_BASE_URL}/${image?.url}`}
+          preview={preview}
         />
       </Card>
     </Box>
@@ -12,6 +12,8 @@ import {
   Card,
   Paper,
   Divider,
+  FormControlLabel,
+  Switch,
 } from "@mui/material";
 import MaskPreview from "../components/MaskPreview";
 import MaskControls from "../components/MaskControls";
@@ -34,12 +36,16 @@ const MaskEditorPage = () => {
     colorHistory,
     currentColor,
     setCurrentColor,
+    blendMode,
+    setBlendMode,
     toggleAllMasks,
     clearSelection,
     handleImageClick,
     handleApplyColor,
     handleDownload,
     handleUndo,
+    handleRedo,
+    canRedo,
     removeColor,
     masksGenerated,
     imageRef,
@@ -142,6 +148,21 @@ const MaskEditorPage = () => {
               disabled={!masksGenerated}
             />
 
+            <Tooltip title="Keep the shading and texture of the wall under the paint">
+              <FormControlLabel
+                control={
+                  <Switch
+                    checked={blendMode === "retain_texture"}
+                    onChange={(e) =>
+                      setBlendMode(e.target.checked ? "retain_texture" : "flat")
+                    }
+                    disabled={!masksGenerated}
+                  />
+                }
+                label="Keep texture"
+              />
+            </Tooltip>
+
             <Stack direction="row" spacing={2}>
               <Button
                 variant="contained"
@@ -167,6 +188,15 @@ const MaskEditorPage = () => {
               >
                 Undo
               </Button>
+              <Button
+                variant="outlined"
+                onClick={handleRedo}
+                disabled={!canRedo}
+                fullWidth
+                sx={{ fontWeight: 600, borderRadius: 3 }}
+              >
+                Redo
+              </Button>
             </Stack>
 
             {!!colorHistory.length && (
@@ -11,8 +11,32 @@ export const uploadImage = (formData) =>
     },
   });
 
-export const generateMasksService = (filename) =>
-  api.post(`${import.meta.env.VITE_API_BASE_URL}/api/masks/generate`, { filename });
+// Streams /api/masks/generate/stream, calling onEvent for each NDJSON line.
+// Uses fetch since axios cannot read a response body incrementally.
+export const generateMasksStreamService = async (filename, onEvent) => {
+  const response = await fetch(
+    `${import.meta.env.VITE_API_BASE_URL}/api/masks/generate/stream`,
+    {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ filename }),
+    }
+  );
+  if (!response.ok) {
+    throw new Error(`Mask generation failed (${response.status})`);
+  }
+
+  const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+  let buffered = "";
+  for (;;) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffered += value;
+    const lines = buffered.split("\n");
+    buffered = lines.pop();
+    lines.filter(Boolean).forEach((line) => onEvent(JSON.parse(line)));
+  }
+};
 
 export const getMaskAtPointsService = (requestData) =>
   api.post(`${import.meta.env.VITE_API_BASE_URL}/api/masks/points`, requestData);
@@ -20,4 +44,24 @@ export const getMaskAtPointsService = (requestData) =>
 export const applyColorsService = (requestData) => 
   api.post(`${import.meta.env.VITE_API_BASE_URL}/api/image/apply-colors`, requestData);
 
+export const createRenderSessionService = (filename) =>
+  api.post(`${import.meta.env.VITE_API_BASE_URL}/api/render/sessions`, { filename });
+
+export const addLayerService = (sessionId, layer) =>
+  api.post(`${import.meta.env.VITE_API_BASE_URL}/api/render/${sessionId}/layers`, layer);
+
+export const deleteLayerService = (sessionId, layerId) =>
+  api.delete(`${import.meta.env.VITE_API_BASE_URL}/api/render/${sessionId}/layers/${layerId}`);
+
+export const undoLayerService = (sessionId) =>
+  api.post(`${import.meta.env.VITE_API_BASE_URL}/api/render/${sessionId}/undo`);
+
+export const redoLayerService = (sessionId) =>
+  api.post(`${import.meta.env.VITE_API_BASE_URL}/api/render/${sessionId}/redo`);
+
+export const exportRenderService = (sessionId) =>
+  api.get(`${import.meta.env.VITE_API_BASE_URL}/api/render/${sessionId}/export`, {
+    responseType: "blob",
+  });
+
 export default api;
@@ -0,0 +1,58 @@
+// Renders the column-major RLE masks of /api/masks/generate/stream. Counts
+// start with a background run.
+
+const MASK_ALPHA = 200;
+
+// Deterministic palette shared with the server: golden-ratio hue steps.
+export const paletteColor = (index) => {
+  const h = (index * 0.618033988749895) % 1;
+  const s = 0.65;
+  const v = 0.95;
+  const i = Math.floor(h * 6);
+  const f = h * 6 - i;
+  const p = v * (1 - s);
+  const q = v * (1 - f * s);
+  const t = v * (1 - (1 - f) * s);
+  const [r, g, b] = [
+    [v, t, p],
+    [q, v, p],
+    [p, v, t],
+    [p, q, v],
+    [t, p, v],
+    [v, p, q],
+  ][i % 6];
+  return [Math.round(r * 255), Math.round(g * 255), Math.round(b * 255)];
+};
+
+// Paints one RLE into RGBA pixel data (row-major), later calls on top.
+export const paintRle = (pixels, counts, width, height, rgba) => {
+  let idx = 0;
+  for (let k = 0; k < counts.length; k++) {
+    const run = counts[k];
+    if (k % 2 === 1) {
+      for (let j = idx; j < idx + run; j++) {
+        const x = Math.floor(j / height);
+        const y = j - x * height;
+        pixels.set(rgba, (y * width + x) * 4);
+      }
+    }
+    idx += run;
+  }
+};
+
+const toPngBase64 = (pixels, width, height) => {
+  const canvas = document.createElement("canvas");
+  canvas.width = width;
+  canvas.height = height;
+  canvas.getContext("2d").putImageData(new ImageData(pixels, width, height), 0, 0);
+  return canvas.toDataURL("image/png").split(",")[1];
+};
+
+// Renders all masks into one base64 PNG overlay, like the legacy composite_mask.
+export const compositeFromRle = ({ width, height, masks }) => {
+  const pixels = new Uint8ClampedArray(width * height * 4);
+  masks.forEach((mask, i) =>
+    paintRle(pixels, mask.counts, width, height, [...paletteColor(i), MASK_ALPHA])
+  );
+  return toPngBase64(pixels, width, height);
+};
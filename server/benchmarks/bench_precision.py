@@ -0,0 +1,109 @@
+# Compares reduced-precision inference against fp32, for accuracy and speed.
+#
+#   python benchmarks/bench_precision.py [--precision bf16] [--checkpoint PATH] [photo.jpg ...]
+#
+# The same model runs the image predictor (a grid of single-point prompts,
+# multimask output) and the automatic mask generator with the server's
+# settings, once in fp32 and once in the given precision. Reported are the
+# encoder/AMG timings and the mask IoU against fp32: per prompt and mask for
+# the predictor, and for the AMG each fp32 mask matched to its best
+# counterpart (on a 1/4 subsampled grid). Exits with status 1 if the mean
+# IoU of either falls below --min-iou, so it doubles as a parity check before
+# changing INFERENCE_PRECISION. Without photos a synthetic 1536x1152 frame
+# is used.
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench_recolor import synthetic_house  # noqa: E402
+from sam2.automatic_mask_generator import SAM2AutomaticMaskGenerator  # noqa: E402
+from sam2.build_sam import build_sam2  # noqa: E402
+from sam2.sam2_image_predictor import SAM2ImagePredictor  # noqa: E402
+from sam2.utils.amg import rle_to_mask  # noqa: E402
+
+
+def timed(fn):
+    start = time.perf_counter()
+    out = fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return out, time.perf_counter() - start
+
+
+def iou(a, b):
+    union = np.logical_or(a, b).sum()
+    return 1.0 if union == 0 else np.logical_and(a, b).sum() / union
+
+
+def predictor_masks(model, precision, image, points):
+    predictor = SAM2ImagePredictor(model, precision=precision)
+    _, seconds = timed(lambda: predictor.set_image(image))
+    masks = [
+        predictor.predict(point_coords=p[None], point_labels=np.array([1]), multimask_output=True)[0]
+        for p in points
+    ]
+    return masks, seconds
+
+
+def amg_masks(model, precision, image):
+    generator = SAM2AutomaticMaskGenerator(
+        model=model,
+        points_per_side=32,
+        pred_iou_thresh=0.56,
+        stability_score_thresh=0.92,
+        crop_n_layers=1,
+        crop_n_points_downscale_factor=2,
+        min_mask_region_area=100,
+        output_mode="uncompressed_rle",
+        precision=precision,
+    )
+    records, seconds = timed(lambda: generator.generate(image))
+    # Compared on every 4th pixel to keep hundreds of masks in memory
+    return [rle_to_mask(r["segmentation"])[::4, ::4] for r in records], seconds
+
+
+def compare(name, model, precision, image, min_iou):
+    h, w = image.shape[:2]
+    ys, xs = np.meshgrid(np.linspace(0.1, 0.9, 4) * h, np.linspace(0.1, 0.9, 4) * w, indexing="ij")
+    points = np.stack([xs.ravel(), ys.ravel()], axis=1)
+    print(f"{name}: {w}x{h}, fp32 vs {precision}")
+
+    ref, ref_s = predictor_masks(model, "fp32", image, points)
+    low, low_s = predictor_masks(model, precision, image, points)
+    ious = [iou(a, b) for ra, rb in zip(ref, low) for a, b in zip(ra, rb)]
+    print(f"  set_image          : {ref_s:.3f}s -> {low_s:.3f}s")
+    print(f"  predictor mask IoU : mean {np.mean(ious):.4f}, min {np.min(ious):.4f}")
+
+    ref, ref_s = amg_masks(model, "fp32", image)
+    low, low_s = amg_masks(model, precision, image)
+    best = [max((iou(a, b) for b in low), default=0.0) for a in ref]
+    amg_iou = float(np.mean(best)) if best else 1.0
+    print(f"  generate           : {ref_s:.3f}s -> {low_s:.3f}s")
+    print(f"  AMG masks          : {len(ref)} -> {len(low)}, best-match IoU mean {amg_iou:.4f}")
+    return min(np.mean(ious), amg_iou) >= min_iou
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("images", nargs="*")
+    parser.add_argument("--precision", default="bf16", choices=["bf16", "fp16"])
+    parser.add_argument("--config", default="configs/sam2.1/sam2.1_hiera_l.yaml")
+    parser.add_argument("--checkpoint", default="models/sam2.1_hiera_large.pt")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--min-iou", type=float, default=0.95)
+    args = parser.parse_args()
+
+    model = build_sam2(args.config, args.checkpoint, device=args.device)
+    if args.images:
+        frames = [(os.path.basename(p), np.array(Image.open(p).convert("RGB"))) for p in args.images]
+    else:
+        frames = [("synthetic", synthetic_house(1152, 1536)[..., :3])]
+    ok = [compare(name, model, args.precision, image, args.min_iou) for name, image in frames]
+    sys.exit(0 if all(ok) else 1)
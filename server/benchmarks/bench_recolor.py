@@ -0,0 +1,108 @@
+# Benchmarks apply-colors blending on 4K and 12MP frames.
+#
+#   python benchmarks/bench_recolor.py [photo.jpg ...]
+#
+# Without arguments, synthetic house-like frames (textured walls, a roof band
+# and windows) are generated at 3840x2160 and 4000x3000. Each frame is painted
+# with three wall masks covering roughly 35% of the image, using the legacy
+# full-frame float64 blend, the masked 'flat' blend and 'retain_texture'.
+#
+# It then checks, for both modes, that editing and removing the bottom layer
+# of an overlapping LayerStack gives the same pixels as rendering the
+# remaining layers from scratch, and exits with status 1 if it does not.
+
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from layer_stack import LayerStack  # noqa: E402
+from recolor import apply_operations, mask_pixels  # noqa: E402
+
+COLORS = [(74, 144, 226, 255), (245, 166, 35, 255), (80, 227, 194, 178)]
+
+
+def synthetic_house(h, w, seed=0):
+    rng = np.random.default_rng(seed)
+    img = np.empty((h, w, 4), dtype=np.uint8)
+    shade = np.linspace(0.75, 1.0, w, dtype=np.float32)[None, :, None]
+    wall = np.array([225, 215, 196], dtype=np.float32) * shade
+    img[..., :3] = np.clip(wall + rng.normal(0, 8, (h, w, 3)), 0, 255)
+    img[: h // 5, :, :3] = [120, 60, 50]
+    img[..., 3] = 255
+    return img
+
+
+def wall_masks(h, w):
+    masks = []
+    for x0, x1 in ((0.05, 0.35), (0.4, 0.65), (0.7, 0.95)):
+        m = np.zeros((h, w), dtype=bool)
+        m[h // 5 : int(h * 0.9), int(w * x0) : int(w * x1)] = True
+        # Cut out windows
+        m[int(h * 0.4) : int(h * 0.6), int(w * (x0 + 0.05)) : int(w * (x0 + 0.12))] = False
+        masks.append(m)
+    return masks
+
+
+def legacy_blend(arr, masks):
+    for mask, rgba in zip(masks, COLORS):
+        col = np.zeros_like(arr)
+        col[mask] = rgba
+        alpha = col[:, :, 3:] / 255.0
+        arr = (arr * (1 - alpha) + col * alpha).astype(np.uint8)
+    return arr
+
+
+def timeit(fn, runs=3):
+    best = float("inf")
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench(name, img):
+    h, w = img.shape[:2]
+    masks = wall_masks(h, w)
+    pixels = [mask_pixels(m, (h, w)) for m in masks]
+    coverage = sum(len(p) for p in pixels) / (h * w)
+    print(f"{name}: {w}x{h}, masks cover {coverage:.0%}")
+    print(f"  legacy float64 full-frame : {timeit(lambda: legacy_blend(img, masks)):.3f}s")
+    for mode in ("flat", "retain_texture"):
+        ops = [(p, rgba, mode) for p, rgba in zip(pixels, COLORS)]
+        print(f"  {mode:<26}: {timeit(lambda: apply_operations(img, ops)):.3f}s")
+    return all([layer_parity(img, pixels, mode) for mode in ("flat", "retain_texture")])
+
+
+def layer_parity(img, pixels, mode):
+    h, w = img.shape[:2]
+    # A band across all walls, under them, so every edit is replayed on overlaps
+    band = np.zeros((h, w), dtype=bool)
+    band[h // 3 : h // 2] = True
+    stack = LayerStack(img)
+    bottom = stack.add(mask_pixels(band, (h, w)), (40, 40, 40, 255), mode)
+    for p, rgba in zip(pixels, COLORS):
+        stack.add(p, rgba, mode)
+    worst = 0
+    for edit in (lambda: stack.update(bottom, (250, 250, 250, 128)), lambda: stack.remove(bottom)):
+        start = time.perf_counter()
+        edit()
+        seconds = time.perf_counter() - start
+        full = apply_operations(img, stack.operations())
+        diff = int(np.abs(stack.composite.astype(np.int16) - full).max())
+        worst = max(worst, diff)
+        print(f"  {mode} layer edit {seconds:.3f}s, max diff vs full render {diff}")
+    return worst == 0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        frames = [(os.path.basename(p), np.array(Image.open(p).convert("RGBA"))) for p in sys.argv[1:]]
+    else:
+        frames = [("4K", synthetic_house(2160, 3840)), ("12MP", synthetic_house(3000, 4000))]
+    ok = [bench(name, img) for name, img in frames]
+    sys.exit(0 if all(ok) else 1)
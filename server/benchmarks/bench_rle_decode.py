@@ -0,0 +1,78 @@
+# Benchmarks decoding the uncompressed RLEs of one image's masks.
+#
+#   python benchmarks/bench_rle_decode.py [n_masks]
+#
+# Synthetic masks (discs of random size plus speckle, 200 by default) are
+# encoded at the working size (1536x1152) and at 12MP (4000x3000), then
+# decoded with the legacy per-count loop, the vectorized rle_to_mask called
+# once per mask, RLEBatch.to_masks decoding all of them in one call, and
+# mask_codec.label_map for the uint16 label map.
+
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mask_codec import label_map  # noqa: E402
+from sam2.utils.amg import RLEBatch, rle_to_mask  # noqa: E402
+
+
+def synthetic_masks(n, h, w, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    yy, xx = torch.meshgrid(torch.arange(h), torch.arange(w), indexing="ij")
+    cy = torch.randint(0, h, (n,), generator=g)
+    cx = torch.randint(0, w, (n,), generator=g)
+    r = torch.randint(min(h, w) // 60, min(h, w) // 4, (n,), generator=g)
+    rles = []
+    # Encoded in chunks to bound the memory of the boolean masks
+    for start in range(0, n, 16):
+        idx = range(start, min(n, start + 16))
+        masks = torch.stack([(yy - cy[i]) ** 2 + (xx - cx[i]) ** 2 < r[i] ** 2 for i in idx])
+        masks |= torch.rand(masks.shape, generator=g) > 0.999
+        rles.append(RLEBatch.from_masks(masks))
+    batch = rles[0]
+    for other in rles[1:]:
+        batch = batch.cat(other)
+    return batch
+
+
+def legacy_rle_to_mask(rle):
+    h, w = rle["size"]
+    mask = np.empty(h * w, dtype=bool)
+    idx = 0
+    parity = False
+    for count in rle["counts"]:
+        mask[idx : idx + count] = parity
+        idx += count
+        parity ^= True
+    mask = mask.reshape(w, h)
+    return mask.transpose()
+
+
+def timeit(fn, runs=3):
+    best = float("inf")
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench(name, n, h, w):
+    batch = synthetic_masks(n, h, w)
+    rles = batch.to_list()
+    records = [{"segmentation": rle} for rle in rles]
+    print(f"{name}: {w}x{h}, {n} masks, {len(batch.counts)} counts")
+    print(f"  legacy loop per mask   : {timeit(lambda: [legacy_rle_to_mask(r) for r in rles]):.3f}s")
+    print(f"  rle_to_mask per mask   : {timeit(lambda: [rle_to_mask(r) for r in rles]):.3f}s")
+    print(f"  RLEBatch.to_masks      : {timeit(batch.to_masks):.3f}s")
+    print(f"  label_map (uint16)     : {timeit(lambda: label_map(records, (h, w))):.3f}s")
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    bench("working copy", n, 1152, 1536)
+    bench("12MP", n, 3000, 4000)
@@ -0,0 +1,63 @@
+import asyncio
+from collections import defaultdict
+
+from inference_queue import PRIORITY_INTERACTIVE
+
+
+class DecoderBatcher:
+    """
+    Collects point prompts that arrive within `window_ms` of each other and
+    groups them by image key and prompt length, so each group costs a single
+    mask decoder call. `run_group(key, prompts)` runs on the inference
+    executor and must return one result per prompt, in order.
+    """
+
+    def __init__(self, executor, run_group, window_ms: float = 5.0, max_batch: int = 16):
+        self.executor = executor
+        self.run_group = run_group
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.batches = 0
+        self.prompts = 0
+        self._pending = []
+        self._timer = None
+
+    async def submit(self, key, prompt):
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._pending.append((key, prompt, fut))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await fut
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, []
+        groups = defaultdict(list)
+        for key, prompt, fut in pending:
+            groups[(key, len(prompt))].append((prompt, fut))
+        for (key, _), group in groups.items():
+            asyncio.ensure_future(self._run(key, group))
+
+    async def _run(self, key, group):
+        prompts = [prompt for prompt, _ in group]
+        self.batches += 1
+        self.prompts += len(prompts)
+        try:
+            results = await self.executor.run(PRIORITY_INTERACTIVE, self.run_group, key, prompts)
+        except Exception as e:
+            for _, fut in group:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for (_, fut), result in zip(group, results):
+            if not fut.done():
+                fut.set_result(result)
+
+    def stats(self):
+        return {"batches": self.batches, "prompts": self.prompts,
+                "avg_batch": round(self.prompts / self.batches, 2) if self.batches else 0.0}
@@ -0,0 +1,87 @@
+import os, tempfile, threading
+
+
+class DiskLRU:
+    """
+    Directory of cache files named `<key><suffix>`, bounded by their total
+    size. Files are written atomically (temp file + rename) and the least
+    recently used ones are deleted first; recency survives restarts through
+    file mtimes. Thread-safe. Write errors are swallowed since a cache must
+    never fail the request that fills it.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, suffix: str):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        entries = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith(".tmp"):
+                # Left behind by a write that never completed
+                os.remove(path)
+            elif name.endswith(suffix):
+                st = os.stat(path)
+                entries.append((st.st_mtime_ns, name[: -len(suffix)], st.st_size))
+        # Dicts keep insertion order, oldest first
+        self._sizes = {key: size for _, key, size in sorted(entries)}
+        self.nbytes = sum(self._sizes.values())
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + self.suffix)
+
+    def touch(self, key: str) -> bool:
+        """Marks an entry as used, returns False if there is none."""
+        with self._lock:
+            if key not in self._sizes:
+                return False
+            self._sizes[key] = self._sizes.pop(key)
+        try:
+            os.utime(self.path(key))
+        except OSError:
+            pass
+        return True
+
+    def discard(self, key: str):
+        with self._lock:
+            self.nbytes -= self._sizes.pop(key, 0)
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def write(self, key: str, write) -> bool:
+        """Stores an entry by calling write(file) on a temp file, then renaming it."""
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            size = os.path.getsize(tmp)
+            if size > self.max_bytes:
+                os.remove(tmp)
+                return False
+            os.replace(tmp, self.path(key))
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return False
+        with self._lock:
+            self.nbytes += size - self._sizes.pop(key, 0)
+            self._sizes[key] = size
+            evicted = []
+            while self.nbytes > self.max_bytes:
+                oldest = next(iter(self._sizes))
+                self.nbytes -= self._sizes.pop(oldest)
+                evicted.append(oldest)
+        for key in evicted:
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._sizes), "bytes": self.nbytes, "max_bytes": self.max_bytes}
@@ -0,0 +1,88 @@
+import hashlib, os, threading
+from collections import OrderedDict
+
+_digests = {}
+_digests_lock = threading.Lock()
+
+
+def file_digest(path: str) -> str:
+    """SHA-256 of a file's contents, memoized on (path, mtime, size)."""
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+    with _digests_lock:
+        digest = _digests.get(key)
+    if digest is None:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        digest = h.hexdigest()
+        with _digests_lock:
+            if len(_digests) > 4096:
+                _digests.clear()
+            _digests[key] = digest
+    return digest
+
+
+def remember_digest(path: str, digest: str):
+    """Seeds file_digest for a file whose hash is already known, e.g. from its upload."""
+    st = os.stat(path)
+    with _digests_lock:
+        _digests[(os.path.abspath(path), st.st_mtime_ns, st.st_size)] = digest
+
+
+def state_nbytes(state: dict) -> int:
+    feats = state["features"]
+    tensors = [feats["image_embed"], *feats["high_res_feats"]]
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class EmbeddingCache:
+    """
+    Per-process LRU cache of SAM2ImagePredictor image states, keyed by the
+    content hash of the image and bounded by the total size of the features.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: str, state: dict):
+        size = state_nbytes(state)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            self._entries[key] = (state, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.nbytes -= evicted
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.nbytes,
+                    "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses}
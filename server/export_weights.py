@@ -0,0 +1,22 @@
+# Prepares a checkpoint for fast container starts, at deploy time:
+#
+#   python export_weights.py models/sam2.1_hiera_large.pt
+#
+# Records the checkpoint's SHA-256 in <checkpoint>.sha256, so download_file
+# accepts it without probing or hashing it again, and writes the
+# safetensors export that fast_checkpoint loads by memory-mapping instead
+# of unpickling. Requires the safetensors package.
+
+import os
+import sys
+
+from model_download import exported_weights_path, record_digest
+from sam2.build_sam import export_safetensors
+
+if __name__ == "__main__":
+    for checkpoint in sys.argv[1:]:
+        record_digest(checkpoint)
+        exported = exported_weights_path(checkpoint)
+        if not os.path.exists(exported):
+            export_safetensors(checkpoint, exported)
+        print(f"{checkpoint} -> {exported}")
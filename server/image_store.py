@@ -0,0 +1,111 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image as PILImage
+
+from disk_cache import DiskLRU
+from embedding_cache import file_digest
+
+
+def decode_image(path: str, max_side: int = 0) -> np.ndarray:
+    """
+    HxWx4 uint8 if the image has transparency, HxWx3 otherwise. If max_side
+    is set, larger images are downscaled to fit it, keeping the aspect ratio.
+    """
+    with PILImage.open(path) as img:
+        has_alpha = "A" in img.getbands() or "transparency" in img.info
+        mode = "RGBA" if has_alpha else "RGB"
+        if not max_side or max(img.size) <= max_side:
+            return np.array(img.convert(mode))
+        scale = max_side / max(img.size)
+        size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        # JPEGs decode straight at 1/2, 1/4 or 1/8 scale when that still covers `size`
+        img.draft(mode, size)
+        return np.array(img.convert(mode).resize(size, PILImage.LANCZOS))
+
+
+def image_size(path: str):
+    """(height, width) from the file header, without decoding."""
+    with PILImage.open(path) as img:
+        return img.height, img.width
+
+
+def as_rgba(arr: np.ndarray) -> np.ndarray:
+    if arr.shape[-1] == 4:
+        return arr
+    out = np.empty((*arr.shape[:2], 4), dtype=np.uint8)
+    out[..., :3] = arr
+    out[..., 3] = 255
+    return out
+
+
+class ImageStore:
+    """
+    Decodes each upload once into its working copy, downscaled so the long
+    side is at most max_side (0 keeps the original size). The pixels are
+    written next to the other caches as a raw .npy file and later requests
+    memory-map it (copy-on-write, so no decode and no copy), while the most
+    recently used arrays are also kept in a small in-process LRU bounded by
+    max_ram_bytes.
+
+    Arrays are shared between requests: callers must not modify them.
+    """
+
+    def __init__(self, directory: str, max_disk_bytes: int, max_ram_bytes: int, max_side: int = 0):
+        self.files = DiskLRU(directory, max_disk_bytes, ".npy")
+        self.max_ram_bytes = max_ram_bytes
+        self.max_side = max_side
+        self.nbytes = 0
+        self.decodes = 0
+        self.maps = 0
+        self.hits = 0
+        self._hot = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: str) -> np.ndarray:
+        key = f"{file_digest(path)}-{self.max_side}"
+        with self._lock:
+            arr = self._hot.get(key)
+            if arr is not None:
+                self._hot.move_to_end(key)
+                self.hits += 1
+                return arr
+        arr = self._load(key)
+        if arr is None:
+            arr = decode_image(path, self.max_side)
+            self.files.write(key, lambda f: np.save(f, arr))
+            with self._lock:
+                self.decodes += 1
+        with self._lock:
+            if key not in self._hot and arr.nbytes <= self.max_ram_bytes:
+                self._hot[key] = arr
+                self.nbytes += arr.nbytes
+                while self.nbytes > self.max_ram_bytes:
+                    _, evicted = self._hot.popitem(last=False)
+                    self.nbytes -= evicted.nbytes
+        return arr
+
+    def _load(self, key):
+        if not self.files.touch(key):
+            return None
+        try:
+            arr = np.load(self.files.path(key), mmap_mode="c")
+        except (OSError, ValueError):
+            self.files.discard(key)
+            return None
+        with self._lock:
+            self.maps += 1
+        return arr
+
+    def rgb(self, path: str) -> np.ndarray:
+        return self.get(path)[..., :3]
+
+    def rgba(self, path: str) -> np.ndarray:
+        return as_rgba(self.get(path))
+
+    def stats(self):
+        with self._lock:
+            return {**self.files.stats(), "ram_entries": len(self._hot), "ram_bytes": self.nbytes,
+                    "max_ram_bytes": self.max_ram_bytes, "decodes": self.decodes,
+                    "maps": self.maps, "hits": self.hits}
@@ -0,0 +1,143 @@
+import asyncio, heapq, itertools, threading, time
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class QueueTimeoutError(Exception):
+    pass
+
+
+def _resolve(fut, result, exc):
+    if fut.cancelled():
+        return
+    if exc is not None:
+        fut.set_exception(exc)
+    else:
+        fut.set_result(result)
+
+
+class InferenceExecutor:
+    """
+    Runs blocking model work on dedicated worker threads, off the event loop.
+    Jobs wait in a bounded priority queue (lower value runs first, FIFO within
+    a priority); submitting to a full queue raises QueueFullError and jobs that
+    waited longer than max_wait seconds fail with QueueTimeoutError.
+
+    At most max_bulk jobs of PRIORITY_BULK or lower priority run at once, and
+    further bulk jobs stay queued instead of taking a worker, so with
+    workers > max_bulk interactive jobs always find a free worker.
+    """
+
+    def __init__(self, workers: int = 1, max_queued: int = 32, max_wait: float = 30.0,
+                 max_bulk: int = None):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.max_bulk = workers if max_bulk is None else max_bulk
+        self._heap = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._running = 0
+        self._running_bulk = 0
+        self._completed = 0
+        self._rejected = 0
+        self._expired = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._last_wait = 0.0
+        for i in range(workers):
+            threading.Thread(target=self._work, name=f"inference-{i}", daemon=True).start()
+
+    async def run(self, priority: int, fn, *args, **kwargs):
+        return await self.submit(priority, fn, *args, **kwargs)
+
+    def submit(self, priority: int, fn, *args, **kwargs) -> asyncio.Future:
+        """
+        Enqueues a job and returns its future without waiting, so callers can
+        learn about a full queue before committing to a (streaming) response.
+        Must be called from the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        item = (priority, next(self._seq), time.monotonic(), loop, fut, fn, args, kwargs)
+        with self._lock:
+            if len(self._heap) >= self.max_queued:
+                self._rejected += 1
+                raise QueueFullError(f"inference queue is full ({self.max_queued} jobs)")
+            heapq.heappush(self._heap, item)
+            self._ready.notify()
+        return fut
+
+    def _take(self):
+        # The heap head is the most urgent job; if it is bulk, every queued
+        # job is, so nothing can run until a bulk slot frees up
+        with self._ready:
+            while not self._heap or (self._heap[0][0] >= PRIORITY_BULK
+                                     and self._running_bulk >= self.max_bulk):
+                self._ready.wait()
+            item = heapq.heappop(self._heap)
+            bulk = item[0] >= PRIORITY_BULK
+            if bulk:
+                self._running_bulk += 1
+            return bulk, item
+
+    def _release(self, bulk):
+        with self._ready:
+            if bulk:
+                self._running_bulk -= 1
+                self._ready.notify()
+
+    def _work(self):
+        while True:
+            bulk, (_, _, enqueued, loop, fut, fn, args, kwargs) = self._take()
+            waited = time.monotonic() - enqueued
+            with self._lock:
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+                self._last_wait = waited
+            if fut.cancelled():
+                self._release(bulk)
+                continue
+            if waited > self.max_wait:
+                with self._lock:
+                    self._expired += 1
+                self._release(bulk)
+                exc = QueueTimeoutError(f"waited {waited:.1f}s for a worker")
+                loop.call_soon_threadsafe(_resolve, fut, None, exc)
+                continue
+            with self._lock:
+                self._running += 1
+            result, exc = None, None
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                exc = e
+            with self._lock:
+                self._running -= 1
+                self._completed += 1
+            self._release(bulk)
+            loop.call_soon_threadsafe(_resolve, fut, result, exc)
+
+    def stats(self):
+        with self._lock:
+            served = self._completed + self._expired
+            return {
+                "depth": len(self._heap),
+                "running": self._running,
+                "running_bulk": self._running_bulk,
+                "workers": self.workers,
+                "max_bulk": self.max_bulk,
+                "max_queued": self.max_queued,
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "expired": self._expired,
+                "wait_ms_last": round(self._last_wait * 1000, 1),
+                "wait_ms_avg": round(self._wait_total / served * 1000, 1) if served else 0.0,
+                "wait_ms_max": round(self._wait_max * 1000, 1),
+            }
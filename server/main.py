@@ -1,57 +1,280 @@
 from beam import asgi, Image
-import os, io, base64, numpy as np, torch, requests
-from fastapi import FastAPI, UploadFile, File, HTTPException
+import os, io, json, time, base64, asyncio, hashlib, tempfile, numpy as np, torch
+from contextlib import contextmanager
+from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from PIL import Image as PILImage
 
 from sam2.build_sam import build_sam2
+from model_download import download_file, checkpoint_version, exported_weights_path
 from sam2.sam2_image_predictor import SAM2ImagePredictor
 from sam2.automatic_mask_generator import SAM2AutomaticMaskGenerator
+from sam2.utils.amg import generate_crop_boxes, mask_to_rle_pytorch, rle_to_mask
+from embedding_cache import EmbeddingCache, file_digest, remember_digest
+from inference_queue import InferenceExecutor, QueueFullError, QueueTimeoutError, PRIORITY_BULK
+from predictor_pool import PredictorPool
+from decoder_batcher import DecoderBatcher
+from mask_store import HandleStore
+from mask_cache import MaskCache, generator_fingerprint
+from image_store import ImageStore, decode_image, image_size, as_rgba
+from layer_stack import LayerStack
+from recolor import BLEND_MODES, parse_color, mask_pixels, resize_pixels, apply_operations
+from mask_codec import encode_rle_payload, encode_label_map_png, label_map, palette, composite
 
 UPLOAD_FOLDER = "uploads"
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg"}
+MASK_FORMATS = {"png", "rle", "labelmap"}
+UPLOAD_CHUNK_BYTES = 1 << 20
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 64 << 20))
+EMBEDDING_CACHE_BYTES = int(os.environ.get("EMBEDDING_CACHE_BYTES", 1 << 30))
+WARM_EMBEDDINGS = os.environ.get("WARM_EMBEDDINGS", "0") == "1"
+INFERENCE_QUEUE_SIZE = int(os.environ.get("INFERENCE_QUEUE_SIZE", 32))
+INFERENCE_MAX_WAIT = float(os.environ.get("INFERENCE_MAX_WAIT", 30))
+PREDICTOR_POOL_SIZE = int(os.environ.get("PREDICTOR_POOL_SIZE", 2))
+MASK_GENERATOR_POOL_SIZE = int(os.environ.get("MASK_GENERATOR_POOL_SIZE", 1))
+# Image crops the mask generator encodes in one backbone pass (crop_n_layers=1 gives 5)
+CROP_BATCH_SIZE = int(os.environ.get("CROP_BATCH_SIZE", 8))
+# Dedup masks between crops by mask IoU on their RLEs instead of box IoU
+CROP_MASK_NMS = os.environ.get("CROP_MASK_NMS", "0") == "1"
+DECODER_BATCH_WINDOW_MS = float(os.environ.get("DECODER_BATCH_WINDOW_MS", 5))
+DECODER_MAX_BATCH = int(os.environ.get("DECODER_MAX_BATCH", 16))
+MASK_STORE_BYTES = int(os.environ.get("MASK_STORE_BYTES", 256 << 20))
+RENDER_STORE_BYTES = int(os.environ.get("RENDER_STORE_BYTES", 1 << 30))
+RENDER_SESSION_BYTES = int(os.environ.get("RENDER_SESSION_BYTES", 2 << 30))
+BLEND_MODE = os.environ.get("BLEND_MODE", "flat")
+MASK_CACHE_DIR = os.environ.get("MASK_CACHE_DIR", "cache/masks")
+MASK_CACHE_BYTES = int(os.environ.get("MASK_CACHE_BYTES", 2 << 30))
+IMAGE_STORE_DIR = os.environ.get("IMAGE_STORE_DIR", "cache/images")
+IMAGE_STORE_BYTES = int(os.environ.get("IMAGE_STORE_BYTES", 8 << 30))
+IMAGE_RAM_BYTES = int(os.environ.get("IMAGE_RAM_BYTES", 256 << 20))
+# Long side of the working copy that masks and previews are computed on, 0 for full size
+WORKING_LONG_SIDE = int(os.environ.get("WORKING_LONG_SIDE", 1536))
+MODEL_URL = os.environ.get(
+    "MODEL_URL", "https://dl.fbaipublicfiles.com/segment_anything_2/092824/sam2.1_hiera_large.pt")
+# Expected SHA-256 of the checkpoint; without it only the size is checked
+MODEL_SHA256 = os.environ.get("MODEL_SHA256") or None
+MODEL_DOWNLOAD_PARALLEL = int(os.environ.get("MODEL_DOWNLOAD_PARALLEL", 4))
+# Load weights from the safetensors export made by export_weights.py, when present
+SAFETENSORS_WEIGHTS = os.environ.get("SAFETENSORS_WEIGHTS", "1") == "1"
+MODEL_CONFIG_CACHE_DIR = os.environ.get("MODEL_CONFIG_CACHE_DIR", "models/configs")
+# Inference precision of the image encoder and mask decoder: fp32, bf16 (also on CPU)
+# or fp16 (GPUs without bf16 support, such as the T4)
+INFERENCE_PRECISION = os.environ.get("INFERENCE_PRECISION", "fp32")
+# Startup warm-up: a dummy image through set_image, predict and one AMG batch
+WARMUP = os.environ.get("WARMUP", "1") == "1"
+WARMUP_IMAGE_SIZE = int(os.environ.get("WARMUP_IMAGE_SIZE", 1024))
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 def allowed_ext(filename: str):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def parse_points(pts):
+    """
+    Click prompts [{"x", "y", "is_positive"}] with x, y as fractions of the
+    image size -> [(x, y, label)]. Raises ValueError on malformed input, so
+    a bad request fails on its own instead of inside a shared decoder batch.
+    """
+    if not isinstance(pts, list) or not pts:
+        raise ValueError("points must be a non-empty list")
+    parsed = []
+    for p in pts:
+        if not isinstance(p, dict):
+            raise ValueError("Each point must be an object with x and y")
+        try:
+            x, y = float(p["x"]), float(p["y"])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("Each point needs numeric x and y")
+        if not (np.isfinite(x) and np.isfinite(y)):
+            raise ValueError("Point coordinates must be finite")
+        # Clicks on the very edge can land a subpixel outside the image
+        x, y = min(max(x, 0.0), 1.0), min(max(y, 0.0), 1.0)
+        parsed.append((x, y, 1 if p.get("is_positive", True) else 0))
+    return parsed
+
+def save_upload(src, ext):
+    """
+    Streams an upload into UPLOAD_FOLDER in fixed-size chunks, named by the
+    SHA-256 of its content. Returns (filename, deduplicated): identical
+    uploads share one file, so every cache keyed on the content is reused.
+    """
+    h = hashlib.sha256()
+    size = 0
+    fd, tmp = tempfile.mkstemp(dir=UPLOAD_FOLDER, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in iter(lambda: src.read(UPLOAD_CHUNK_BYTES), b""):
+                size += len(chunk)
+                if size > MAX_UPLOAD_BYTES:
+                    raise HTTPException(413, f"Upload larger than {MAX_UPLOAD_BYTES} bytes")
+                h.update(chunk)
+                f.write(chunk)
+        digest = h.hexdigest()
+        fname = f"{digest}.{ext}"
+        path = os.path.join(UPLOAD_FOLDER, fname)
+        deduplicated = os.path.exists(path)
+        if deduplicated:
+            os.remove(tmp)
+        else:
+            os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    remember_digest(path, digest)
+    return fname, deduplicated
+
+def fast_checkpoint(checkpoint):
+    """
+    The safetensors export made for this exact checkpoint at deploy time
+    (export_weights.py), or the checkpoint itself, which build_sam2
+    memory-maps. Nothing is exported here: that would load and rewrite the
+    whole checkpoint on every cold start.
+    """
+    if not SAFETENSORS_WEIGHTS:
+        return checkpoint
+    try:
+        import safetensors  # noqa: F401
+    except ImportError:
+        return checkpoint
+    exported = exported_weights_path(checkpoint)
+    return exported if os.path.exists(exported) else checkpoint
+
 def download_model_if_needed():
-    url = "https://dl.fbaipublicfiles.com/segment_anything_2/092824/sam2.1_hiera_large.pt"
     model_path = "models/sam2.1_hiera_large.pt"
-    os.makedirs("models", exist_ok=True)
-    if not os.path.exists(model_path):
-        response = requests.get(url, stream=True)
-        if response.status_code == 200:
-            with open(model_path, "wb") as f:
-                for chunk in response.iter_content(1024):
-                    f.write(chunk)
-        else:
-            raise RuntimeError("Failed to download SAM2 model.")
-    return model_path
+    return download_file(MODEL_URL, model_path, sha256=MODEL_SHA256, parallel=MODEL_DOWNLOAD_PARALLEL)
+
+@contextmanager
+def timed(timings, phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        timings[phase] = round(time.perf_counter() - start, 3)
+
+def warm_up(mask_generators, predictors, timings):
+    """
+    Runs a dummy image through every model path once, so CUDA context
+    creation, cuDNN autotuning and lazy allocations happen at startup
+    instead of in the first request.
+    """
+    size = WARMUP_IMAGE_SIZE
+    image = np.random.default_rng(0).integers(0, 256, (size, size, 3), dtype=np.uint8)
+    with predictors.checkout() as predictor:
+        with timed(timings, "warmup_set_image"):
+            predictor.set_image(image)
+        with timed(timings, "warmup_predict"):
+            predictor.predict(point_coords=np.array([[size // 2, size // 2]]),
+                              point_labels=np.array([1]), multimask_output=True)
+        predictor.reset_predictor()
+    with mask_generators.checkout() as mask_generator, timed(timings, "warmup_amg_batch"):
+        # Encode the first batch of crops together, as generate() does, and
+        # decode one point batch per distinct crop size
+        crop_boxes, _ = generate_crop_boxes((size, size), mask_generator.crop_n_layers,
+                                            mask_generator.crop_overlap_ratio)
+        crop_boxes = crop_boxes[: max(1, mask_generator.crop_batch_size)]
+        mask_generator.predictor.set_image_batch([image[y0:y1, x0:x1] for x0, y0, x1, y1 in crop_boxes])
+        points = mask_generator.point_grids[0][: mask_generator.points_per_batch]
+        seen = set()
+        with torch.no_grad():
+            for img_idx, (x0, y0, x1, y1) in enumerate(crop_boxes):
+                crop_size = (y1 - y0, x1 - x0)
+                if crop_size in seen:
+                    continue
+                seen.add(crop_size)
+                mask_generator._process_batch(points * np.array([x1 - x0, y1 - y0]), crop_size,
+                                              [x0, y0, x1, y1], (size, size), normalize=True,
+                                              img_idx=img_idx)
+        mask_generator.predictor.reset_predictor()
 
 def init_models():
-    checkpoint = download_model_if_needed()
+    timings = {}
+    started = time.perf_counter()
+    with timed(timings, "download"):
+        checkpoint = download_model_if_needed()
     cfg = "configs/sam2.1/sam2.1_hiera_l.yaml"
     device = "cuda" if torch.cuda.is_available() else "cpu"
-    model = build_sam2(cfg, checkpoint, device=device)
-    mask_generator = SAM2AutomaticMaskGenerator(
-        model=model,
-        points_per_side=32,
-        pred_iou_thresh=0.56,
-        stability_score_thresh=0.92,
-        crop_n_layers=1,
-        crop_n_points_downscale_factor=2,
-        min_mask_region_area=100,
-    )
-    predictor = SAM2ImagePredictor(model)
-    return {"mask_generator": mask_generator, "predictor": predictor}
+    with timed(timings, "find_weights"):
+        weights = fast_checkpoint(checkpoint)
+    with timed(timings, "build_model"):
+        model = build_sam2(cfg, weights, device=device, config_cache_dir=MODEL_CONFIG_CACHE_DIR)
+    with timed(timings, "build_pools"):
+        mask_generators = PredictorPool(lambda: SAM2AutomaticMaskGenerator(
+            model=model,
+            points_per_side=32,
+            pred_iou_thresh=0.56,
+            stability_score_thresh=0.92,
+            crop_n_layers=1,
+            crop_n_points_downscale_factor=2,
+            min_mask_region_area=100,
+            output_mode="uncompressed_rle",
+            precision=INFERENCE_PRECISION,
+            crop_batch_size=CROP_BATCH_SIZE,
+            crop_mask_nms=CROP_MASK_NMS,
+        ), MASK_GENERATOR_POOL_SIZE)
+        # Predictors only hold per-image state, the SAM2Base weights are shared
+        predictors = PredictorPool(lambda: SAM2ImagePredictor(model, precision=INFERENCE_PRECISION),
+                                   PREDICTOR_POOL_SIZE)
+    with timed(timings, "open_caches"):
+        with mask_generators.checkout() as mask_generator:
+            model_tag = (f"{cfg}:{os.path.basename(checkpoint)}:{checkpoint_version(checkpoint)}:"
+                         f"{WORKING_LONG_SIDE}")
+            fingerprint = generator_fingerprint(mask_generator, model_tag)
+        mask_cache = MaskCache(MASK_CACHE_DIR, MASK_CACHE_BYTES, namespace=fingerprint)
+        embeddings = EmbeddingCache(EMBEDDING_CACHE_BYTES)
+        images = ImageStore(IMAGE_STORE_DIR, IMAGE_STORE_BYTES, IMAGE_RAM_BYTES, WORKING_LONG_SIDE)
+    warmed_up = False
+    if WARMUP:
+        try:
+            with timed(timings, "warmup"):
+                warm_up(mask_generators, predictors, timings)
+            warmed_up = True
+        except Exception as e:
+            # The first requests will pay the warm-up cost instead
+            print(f"Warm-up failed: {e!r}")
+    # Bulk jobs (mask generation, embedding precompute) are capped at the
+    # generator pool size, so clicks keep PREDICTOR_POOL_SIZE workers to themselves
+    executor = InferenceExecutor(workers=PREDICTOR_POOL_SIZE + MASK_GENERATOR_POOL_SIZE,
+                                 max_queued=INFERENCE_QUEUE_SIZE, max_wait=INFERENCE_MAX_WAIT,
+                                 max_bulk=MASK_GENERATOR_POOL_SIZE)
+    timings["total"] = round(time.perf_counter() - started, 3)
+    print(f"Startup timings (s): {json.dumps(timings)}")
+    return {"mask_generators": mask_generators, "predictors": predictors,
+            "embeddings": embeddings, "executor": executor, "mask_cache": mask_cache,
+            "images": images, "startup": timings, "warmed_up": warmed_up}
+
+def embed_image(mask_generators, embeddings, images, path):
+    # A bulk job, so it encodes on a mask generator's predictor: bulk jobs are
+    # capped at the generator pool, and the click predictors stay free
+    with mask_generators.checkout() as mask_generator:
+        _embed_image(mask_generator.predictor, embeddings, images, path)
+        mask_generator.predictor.reset_predictor()
+
+def _embed_image(predictor, embeddings, images, path):
+    key = file_digest(path)
+    state = embeddings.get(key)
+    if state is None:
+        predictor.set_image(images.rgb(path))
+        state = predictor.get_image_state()
+        embeddings.put(key, state)
+    else:
+        predictor.set_image_state(state)
+    return state
+
+def encode_png(arr):
+    buf = io.BytesIO()
+    PILImage.fromarray(arr).save(buf, format="PNG")
+    return base64.b64encode(buf.getvalue()).decode()
 
 @asgi(
     name="sam2-service",
     image=Image(python_packages=[
         "fastapi", "pillow", "numpy", "torch",
-        "requests", "sam2", "python-multipart"
+        "requests", "sam2", "python-multipart", "safetensors"
     ]),
     on_start=init_models,
     cpu=4.0,
@@ -69,60 +292,209 @@ def web_server(context):
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
+        expose_headers=["X-Mask-Ids", "X-Mask-Scores"],
     )
     
     app.mount("/uploads", StaticFiles(directory=UPLOAD_FOLDER), name="uploads")
 
     models = context.on_start_value
-    mask_generator = models["mask_generator"]
-    predictor = models["predictor"]
+    mask_generators = models["mask_generators"]
+    predictors = models["predictors"]
+    embeddings = models["embeddings"]
+    executor = models["executor"]
+    mask_cache = models["mask_cache"]
+    images = models["images"]
+    mask_handles = HandleStore(MASK_STORE_BYTES, prefix="m_")
+    renders = HandleStore(RENDER_STORE_BYTES, prefix="r_")
+    sessions = HandleStore(RENDER_SESSION_BYTES, prefix="s_")
+
+    def register_mask(fname, rle):
+        counts = np.asarray(rle["counts"], dtype=np.uint32)
+        entry = {"filename": fname, "rle": {"size": list(rle["size"]), "counts": counts}}
+        return mask_handles.add(entry, counts.nbytes)
+
+    def server_busy():
+        return HTTPException(429, "Server busy, retry shortly", headers={"Retry-After": "1"})
+
+    async def guarded(job):
+        try:
+            return await job
+        except QueueFullError:
+            raise server_busy()
+        except QueueTimeoutError:
+            raise HTTPException(503, "Timed out waiting for inference", headers={"Retry-After": "5"})
+
+    async def run_inference(priority, fn, *args):
+        return await guarded(executor.run(priority, fn, *args))
+
+    async def warm_embedding(path):
+        try:
+            await executor.run(PRIORITY_BULK, embed_image, mask_generators, embeddings, images, path)
+        except (QueueFullError, QueueTimeoutError):
+            pass
 
     @app.get("/health-check")
     async def health_check():
         return {"success": "Ok"}
 
+    @app.get("/ready")
+    async def ready():
+        """
+        Readiness, unlike /health-check which only shows the process is up:
+        the inference queue has room. Models are always loaded by the time
+        this is served; warmed_up tells whether the warm-up pass ran and
+        succeeded.
+        """
+        stats = executor.stats()
+        accepting = stats["depth"] < stats["max_queued"]
+        body = {"ready": accepting, "warmed_up": models["warmed_up"], "startup_s": models["startup"],
+                "queue_depth": stats["depth"]}
+        return Response(json.dumps(body), status_code=200 if accepting else 503,
+                        media_type="application/json")
+
+    @app.get("/api/queue")
+    async def queue_stats():
+        return {"inference": executor.stats(), "embeddings": embeddings.stats(),
+                "mask_cache": mask_cache.stats(),
+                "images": images.stats(),
+                "predictors": predictors.stats(), "mask_generators": mask_generators.stats(),
+                "decoder_batches": batcher.stats(), "masks": mask_handles.stats(),
+                "renders": renders.stats(), "render_sessions": sessions.stats()}
+
     @app.post("/api/upload")
-    async def upload(image: UploadFile = File(...)):
-        fname = image.filename
-        if not allowed_ext(fname):
+    async def upload(background_tasks: BackgroundTasks, image: UploadFile = File(...)):
+        if not allowed_ext(image.filename):
             raise HTTPException(400, "Invalid file type")
+        ext = image.filename.rsplit(".", 1)[1].lower()
+        fname, deduplicated = await run_in_threadpool(save_upload, image.file, ext)
         path = os.path.join(UPLOAD_FOLDER, fname)
-        with open(path, "wb") as f:
-            f.write(await image.read())
-        return {"message": "Uploaded", "filename": fname, "url": f"uploads/{fname}"}
+        if WARM_EMBEDDINGS:
+            background_tasks.add_task(warm_embedding, path)
+        else:
+            # Decode now so the first generate or click does not pay for it
+            background_tasks.add_task(images.get, path)
+        return {"message": "Uploaded", "filename": fname, "url": f"uploads/{fname}",
+                "deduplicated": deduplicated}
 
     @app.post("/api/masks/generate")
     async def generate_masks(data: dict):
         fname = data.get("filename")
+        fmt = data.get("format", "png")
         if not fname:
             raise HTTPException(400, "Filename required")
+        if fmt not in MASK_FORMATS:
+            raise HTTPException(400, f"Unknown format, expected one of {sorted(MASK_FORMATS)}")
         path = os.path.join(UPLOAD_FOLDER, fname)
         if not os.path.exists(path):
             raise HTTPException(404, "Not found")
 
-        img = PILImage.open(path).convert("RGB")
-        arr = np.array(img)
-        masks = mask_generator.generate(arr)
+        cached = await run_in_threadpool(cached_generate, path)
+        image_size, masks = cached or await run_inference(PRIORITY_BULK, run_generate, path)
+        mask_ids = [register_mask(fname, mi["segmentation"]) for mi in masks]
+        if fmt == "rle":
+            payload = encode_rle_payload(masks, image_size)
+            return Response(payload, media_type="application/octet-stream",
+                            headers={"X-Mask-Ids": ",".join(mask_ids)})
+        if fmt == "labelmap":
+            png = await run_in_threadpool(encode_label_map_png, masks, image_size)
+            scores = ",".join(f"{mi['predicted_iou']:.4f}" for mi in masks)
+            return Response(png, media_type="image/png",
+                            headers={"X-Mask-Scores": scores, "X-Mask-Ids": ",".join(mask_ids)})
+        return await run_in_threadpool(render_generate, image_size, masks, mask_ids)
+
+    @app.post("/api/masks/generate/stream")
+    async def generate_masks_stream(data: dict):
+        """
+        Newline-delimited JSON: one {"event": "crop"} line with the masks of
+        each crop as soon as it is done, then {"event": "done"} with the final
+        deduplicated masks and their handles, or {"event": "error"}. Final
+        masks already sent in a crop event carry "ref": [crop, index] instead
+        of their counts.
+        """
+        fname = data.get("filename")
+        if not fname:
+            raise HTTPException(400, "Filename required")
+        path = os.path.join(UPLOAD_FOLDER, fname)
+        if not os.path.exists(path):
+            raise HTTPException(404, "Not found")
+
+        cached = await run_in_threadpool(cached_generate, path)
+        if cached:
+            line = done_event(fname, *cached)
+            return StreamingResponse(iter([line]), media_type="application/x-ndjson")
+
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        streamed = {}
+
+        def on_crop(crop_idx, n_crops, masks):
+            for i, mi in enumerate(masks):
+                streamed[tuple(mi["segmentation"]["counts"])] = [crop_idx, i]
+            line = json.dumps({"event": "crop", "crop": crop_idx, "crops": n_crops,
+                               "masks": [stream_mask(mi) for mi in masks]})
+            loop.call_soon_threadsafe(events.put_nowait, line)
+
+        try:
+            job = executor.submit(PRIORITY_BULK, run_generate, path, on_crop)
+        except QueueFullError:
+            raise server_busy()
+        job.add_done_callback(lambda _: events.put_nowait(None))
 
+        async def lines():
+            while (line := await events.get()) is not None:
+                yield line + "\n"
+            try:
+                image_size, masks = job.result()
+            except QueueTimeoutError:
+                yield json.dumps({"event": "error", "error": "Timed out waiting for inference"}) + "\n"
+                return
+            except Exception:
+                yield json.dumps({"event": "error", "error": "Mask generation failed"}) + "\n"
+                raise
+            yield done_event(fname, image_size, masks, streamed)
+
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    def done_event(fname, image_size, masks, streamed=None):
+        final = []
+        for mi in masks:
+            ref = streamed.get(tuple(mi["segmentation"]["counts"])) if streamed else None
+            entry = {"score": round(mi["predicted_iou"], 4), "ref": ref} if ref else stream_mask(mi)
+            final.append(dict(entry, mask_id=register_mask(fname, mi["segmentation"])))
+        return json.dumps({"event": "done", "image_size": image_size, "masks": final}) + "\n"
+
+    def stream_mask(mi):
+        return {"score": round(mi["predicted_iou"], 4), "bbox": mi["bbox"],
+                "size": mi["segmentation"]["size"], "counts": mi["segmentation"]["counts"]}
+
+    def cached_generate(path):
+        return mask_cache.get(file_digest(path))
+
+    def run_generate(path, on_crop=None):
+        arr = images.rgb(path)
+        with mask_generators.checkout() as mask_generator:
+            masks = mask_generator.generate(arr, on_crop)
+            embeddings.put(file_digest(path), mask_generator.get_image_state())
+        mask_cache.put(file_digest(path), arr.shape[:2], masks)
+        return arr.shape[:2], masks
+
+    def render_generate(image_size, masks, mask_ids):
+        colors = palette(len(masks))
         mask_list = []
-        composite = np.zeros((*arr.shape[:2], 4), dtype=np.uint8)
+        # One reusable RGBA buffer, cleared after each mask is encoded
+        cm = np.zeros((*image_size, 4), dtype=np.uint8)
         for i, mi in enumerate(masks):
-            seg = mi["segmentation"]
-            col = np.random.randint(0, 255, 3)
-            cm = np.zeros((*arr.shape[:2], 4), dtype=np.uint8)
-            cm[seg] = [*col, 200]
-            composite[seg] = cm[seg]
-            buf = io.BytesIO()
-            PILImage.fromarray(cm).save(buf, format="PNG")
-            mask_list.append({"id": i, "score": float(mi["predicted_iou"]),
-                              "mask": base64.b64encode(buf.getvalue()).decode()})
-
-        buf2 = io.BytesIO()
-        PILImage.fromarray(composite).save(buf2, format="PNG")
+            seg = rle_to_mask(mi["segmentation"])
+            cm[seg] = colors[i + 1]
+            mask_list.append({"id": i, "mask_id": mask_ids[i], "score": float(mi["predicted_iou"]),
+                              "mask": encode_png(cm)})
+            cm[seg] = 0
+
+        labels = label_map(masks, image_size)
         return {
             "masks": mask_list,
-            "composite_mask": base64.b64encode(buf2.getvalue()).decode(),
-            "image_size": arr.shape[:2]
+            "composite_mask": encode_png(composite(labels, len(masks))),
+            "image_size": image_size
         }
 
     @app.post("/api/masks/points")
@@ -131,63 +503,173 @@ def web_server(context):
         pts = data.get("points", [])
         if not fname or not pts:
             raise HTTPException(400, "Filename & points required")
+        try:
+            prompt = parse_points(pts)
+        except ValueError as e:
+            raise HTTPException(400, str(e))
         path = os.path.join(UPLOAD_FOLDER, fname)
         if not os.path.exists(path):
             raise HTTPException(404, "Not found")
 
-        img = np.array(PILImage.open(path).convert("RGB"))
-        input_points, labels = [], []
-        for p in pts:
-            x = int(p["x"] * img.shape[1])
-            y = int(p["y"] * img.shape[0])
-            input_points.append([x, y])
-            labels.append(1 if p.get("is_positive", True) else 0)
-
-        predictor.set_image(img)
-        masks, _, _ = predictor.predict(
-            point_coords=np.array(input_points),
-            point_labels=np.array(labels),
-            multimask_output=True,
-        )
-        combined = np.any(masks, axis=0)
+        combined, rle = await guarded(batcher.submit(path, prompt))
         if not combined.any():
             return {"mask": "", "combined": True, "warning": "No valid mask found"}
 
-        buf = io.BytesIO()
-        PILImage.fromarray(combined.astype(np.uint8) * 255).save(buf, format="PNG")
-        return {"mask": base64.b64encode(buf.getvalue()).decode(), "combined": True}
+        mask_png = await run_in_threadpool(encode_png, combined.astype(np.uint8) * 255)
+        return {"mask": mask_png, "mask_id": register_mask(fname, rle), "combined": True}
+
+    def run_points(path, prompts):
+        # One decoder call for every prompt batched on this image
+        with predictors.checkout() as predictor:
+            h, w = _embed_image(predictor, embeddings, images, path)["orig_hw"][0]
+            input_points, labels = [], []
+            for prompt in prompts:
+                input_points.append([[int(x * w), int(y * h)] for x, y, _ in prompt])
+                labels.append([label for _, _, label in prompt])
+
+            _, coords, point_labels, _ = predictor._prep_prompts(
+                np.array(input_points), np.array(labels), None, None, normalize_coords=True
+            )
+            masks, _, _ = predictor._predict(coords, point_labels, multimask_output=True)
+            combined = masks.any(dim=1)
+            rles = mask_to_rle_pytorch(combined)
+        return list(zip(combined.cpu().numpy(), rles))
+
+    batcher = DecoderBatcher(executor, run_points, DECODER_BATCH_WINDOW_MS, DECODER_MAX_BATCH)
 
     @app.post("/api/image/apply-colors")
-    async def apply_colors(data: dict):
+    def apply_colors(data: dict):
         fname = data.get("filename")
         ops = data.get("operations", [])
         prev = data.get("previous_image")
-        if prev:
+        base = data.get("base_revision")
+        blend_mode = data.get("blend_mode", BLEND_MODE)
+        if base:
+            img = renders.get(base)
+            if img is None:
+                raise HTTPException(410, "Unknown or expired revision")
+        elif prev:
             img = PILImage.open(io.BytesIO(base64.b64decode(prev))).convert("RGBA")
         else:
             path = os.path.join(UPLOAD_FOLDER, fname)
             if not os.path.exists(path):
                 raise HTTPException(404, "Not found")
-            img = PILImage.open(path).convert("RGBA")
-
-        arr = np.array(img)
-        for op in ops:
-            mask_arr = np.array(PILImage.open(io.BytesIO(base64.b64decode(op["mask"]))).convert("L")) > 128
-            color = op["color"]
-            if color.startswith("rgba"):
-                parts = [int(x.strip()) for x in color[5:-1].split(",")]
-                r, g, b, a = parts[0], parts[1], parts[2], int(parts[3] * 255)
-            else:
-                h = color.lstrip("#")
-                r, g, b = tuple(int(h[i:i+2], 16) for i in (0, 2, 4))
-                a = 255
-            col = np.zeros_like(arr)
-            col[mask_arr] = [r, g, b, a]
-            alpha = col[:, :, 3:] / 255.0
-            arr = (arr * (1 - alpha) + col * alpha).astype(np.uint8)
+            img = images.rgba(path)
+
+        arr = np.asarray(img)
+        blend_ops = [resolve_op(op, arr.shape[:2], blend_mode) for op in ops]
+        arr = apply_operations(arr, blend_ops)
+
+        return {"colored_image": encode_png(arr), "revision": renders.add(arr, arr.nbytes)}
+
+    def resolve_op(op, shape, default_mode):
+        """(pixels, rgba, mode) of a {mask_id | mask, color, blend_mode} operation."""
+        if op.get("mask_id"):
+            entry = mask_handles.get(op["mask_id"])
+            if entry is None:
+                raise HTTPException(410, "Unknown or expired mask")
+            mask = entry["rle"]
+        elif op.get("mask"):
+            mask = np.array(PILImage.open(io.BytesIO(base64.b64decode(op["mask"]))).convert("L")) > 128
+        else:
+            raise HTTPException(400, "mask_id or mask required")
+        mode = resolve_mode(op.get("blend_mode", default_mode))
+        try:
+            return mask_pixels(mask, shape), parse_color(op["color"]), mode
+        except ValueError as e:
+            raise HTTPException(400, str(e))
+
+    def resolve_mode(mode):
+        if mode not in BLEND_MODES:
+            raise HTTPException(400, f"Unknown blend mode, expected one of {list(BLEND_MODES)}")
+        return mode
 
+    # Layered renders: each session keeps the base image, its paint layers and
+    # the current composite server-side, so edits only touch the pixels involved
+    def get_session(sid):
+        stack = sessions.get(sid)
+        if stack is None:
+            raise HTTPException(410, "Unknown or expired render session")
+        return stack
+
+    def session_response(sid, stack, **extra):
+        sessions.resize(sid, stack.nbytes)
+        return {"session_id": sid, "colored_image": encode_png(stack.composite),
+                **stack.describe(), **extra}
+
+    @app.post("/api/render/sessions")
+    def create_render_session(data: dict):
+        fname = data.get("filename")
+        if not fname:
+            raise HTTPException(400, "Filename required")
+        path = os.path.join(UPLOAD_FOLDER, fname)
+        if not os.path.exists(path):
+            raise HTTPException(404, "Not found")
+        stack = LayerStack(images.rgba(path), source=path)
+        sid = sessions.add(stack, stack.nbytes)
+        return session_response(sid, stack, original_size=image_size(path))
+
+    @app.post("/api/render/{sid}/layers")
+    def add_layer(sid: str, data: dict):
+        stack = get_session(sid)
+        pixels, rgba, mode = resolve_op(data, stack.shape, data.get("blend_mode", BLEND_MODE))
+        layer_id = stack.add(pixels, rgba, mode)
+        return session_response(sid, stack, layer_id=layer_id)
+
+    @app.patch("/api/render/{sid}/layers/{layer_id}")
+    def update_layer(sid: str, layer_id: int, data: dict):
+        stack = get_session(sid)
+        mode = resolve_mode(data["blend_mode"]) if data.get("blend_mode") else None
+        try:
+            rgba = parse_color(data["color"]) if data.get("color") else None
+        except ValueError as e:
+            raise HTTPException(400, str(e))
+        try:
+            stack.update(layer_id, rgba, mode)
+        except KeyError:
+            raise HTTPException(404, "Unknown layer")
+        return session_response(sid, stack)
+
+    @app.delete("/api/render/{sid}/layers/{layer_id}")
+    def delete_layer(sid: str, layer_id: int):
+        stack = get_session(sid)
+        try:
+            stack.remove(layer_id)
+        except KeyError:
+            raise HTTPException(404, "Unknown layer")
+        return session_response(sid, stack)
+
+    @app.post("/api/render/{sid}/undo")
+    def undo_layer(sid: str):
+        stack = get_session(sid)
+        if not stack.undo():
+            raise HTTPException(409, "Nothing to undo")
+        return session_response(sid, stack)
+
+    @app.post("/api/render/{sid}/redo")
+    def redo_layer(sid: str):
+        stack = get_session(sid)
+        if not stack.redo():
+            raise HTTPException(409, "Nothing to redo")
+        return session_response(sid, stack)
+
+    @app.get("/api/render/{sid}/export")
+    def export_render(sid: str):
+        """
+        The session rendered at the upload's original resolution: layers are
+        painted on the working copy, so their masks are upsampled here.
+        """
+        stack = get_session(sid)
+        if not os.path.exists(stack.source):
+            raise HTTPException(404, "Not found")
+        arr = as_rgba(decode_image(stack.source))
+        # The references measured on the working copy keep the shading of
+        # retain_texture layers the same as in the preview
+        ops = [(resize_pixels(pixels, stack.shape, arr.shape[:2]), rgba, mode, reference)
+               for pixels, rgba, mode, reference in stack.operations()]
         buf = io.BytesIO()
-        PILImage.fromarray(arr).save(buf, format="PNG")
-        return {"colored_image": base64.b64encode(buf.getvalue()).decode()}
+        PILImage.fromarray(apply_operations(arr, ops)).save(buf, format="PNG")
+        return Response(buf.getvalue(), media_type="image/png",
+                        headers={"Content-Disposition": 'attachment; filename="colored-building.png"'})
 
     return app
@@ -0,0 +1,107 @@
+import hashlib, io, json, threading
+
+import numpy as np
+
+from disk_cache import DiskLRU
+
+# Generator attributes that change the masks it produces
+_CONFIG_ATTRS = (
+    "points_per_batch", "pred_iou_thresh", "stability_score_thresh", "stability_score_offset",
+    "mask_threshold", "box_nms_thresh", "crop_n_layers", "crop_nms_thresh", "crop_overlap_ratio",
+    "crop_n_points_downscale_factor", "min_mask_region_area", "output_mode", "use_m2m",
+    "multimask_output", "crop_mask_nms",
+)
+
+
+def generator_fingerprint(mask_generator, model_tag: str) -> str:
+    """
+    Hash of an automatic mask generator's parameters and precision, its
+    point grids (which encode points_per_side) and the model weights it
+    runs, so cached results are never served for a different configuration.
+    """
+    h = hashlib.sha256(model_tag.encode())
+    config = {name: getattr(mask_generator, name) for name in _CONFIG_ATTRS}
+    config["precision"] = mask_generator.predictor.precision
+    h.update(json.dumps(config, sort_keys=True).encode())
+    for grid in mask_generator.point_grids:
+        h.update(np.ascontiguousarray(grid, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+def _pack(image_size, masks) -> bytes:
+    counts = [np.asarray(mi["segmentation"]["counts"], dtype=np.uint32) for mi in masks]
+    arrays = {
+        "image_size": np.asarray(image_size, dtype=np.int64),
+        "counts": np.concatenate(counts) if counts else np.zeros(0, dtype=np.uint32),
+        "n_counts": np.array([len(c) for c in counts], dtype=np.int64),
+        "area": np.array([mi["area"] for mi in masks], dtype=np.int64),
+        "bbox": np.array([mi["bbox"] for mi in masks], dtype=np.float64).reshape(-1, 4),
+        "predicted_iou": np.array([mi["predicted_iou"] for mi in masks], dtype=np.float64),
+        "point_coords": np.array([mi["point_coords"][0] for mi in masks], dtype=np.float64).reshape(-1, 2),
+        "stability_score": np.array([mi["stability_score"] for mi in masks], dtype=np.float64),
+        "crop_box": np.array([mi["crop_box"] for mi in masks], dtype=np.float64).reshape(-1, 4),
+    }
+    buf = io.BytesIO()
+    np.savez(buf, **arrays)
+    return buf.getvalue()
+
+
+def _unpack(f):
+    with np.load(f) as data:
+        h, w = (int(x) for x in data["image_size"])
+        counts = np.split(data["counts"], np.cumsum(data["n_counts"])[:-1])
+        masks = [
+            {
+                "segmentation": {"size": [h, w], "counts": c.tolist()},
+                "area": int(data["area"][i]),
+                "bbox": data["bbox"][i].tolist(),
+                "predicted_iou": float(data["predicted_iou"][i]),
+                "point_coords": [data["point_coords"][i].tolist()],
+                "stability_score": float(data["stability_score"][i]),
+                "crop_box": data["crop_box"][i].tolist(),
+            }
+            for i, c in enumerate(counts[: len(data["n_counts"])])
+        ]
+    return (h, w), masks
+
+
+class MaskCache:
+    """
+    On-disk cache of automatic mask generator output (uncompressed RLE
+    records), keyed by the image content hash within a generator
+    `namespace` (see generator_fingerprint), one .npz file per image.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, namespace: str = ""):
+        self.files = DiskLRU(directory, max_bytes, ".npz")
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _key(self, image_digest: str) -> str:
+        return hashlib.sha256(f"{self.namespace}:{image_digest}".encode()).hexdigest()
+
+    def get(self, image_digest: str):
+        """Returns (image_size, masks) as produced by generate, or None."""
+        key = self._key(image_digest)
+        result = None
+        if self.files.touch(key):
+            try:
+                result = _unpack(self.files.path(key))
+            except (OSError, ValueError, KeyError):
+                self.files.discard(key)
+        with self._lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return result
+
+    def put(self, image_digest: str, image_size, masks):
+        payload = _pack(image_size, masks)
+        self.files.write(self._key(image_digest), lambda f: f.write(payload))
+
+    def stats(self):
+        with self._lock:
+            return {**self.files.stats(), "hits": self.hits, "misses": self.misses}
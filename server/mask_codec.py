@@ -0,0 +1,101 @@
+import io, struct
+
+import numpy as np
+from PIL import Image as PILImage
+
+RLE_MAGIC = b"RLE1"
+
+
+def encode_rle_payload(masks, image_size) -> bytes:
+    """
+    Packs the uncompressed COCO RLEs of AMG records into one little-endian
+    binary payload:
+
+        b"RLE1", uint32 height, uint32 width, uint32 n_masks,
+        then per mask: float32 score, uint32 n_counts, uint32 counts[n_counts]
+
+    Counts are column-major (Fortran order) and start with a background run,
+    exactly as produced by mask_to_rle_pytorch.
+    """
+    h, w = image_size
+    parts = [RLE_MAGIC, struct.pack("<III", h, w, len(masks))]
+    for mi in masks:
+        counts = np.asarray(mi["segmentation"]["counts"], dtype="<u4")
+        parts.append(struct.pack("<fI", float(mi["predicted_iou"]), counts.size))
+        parts.append(counts.tobytes())
+    return b"".join(parts)
+
+
+def decode_rle_payload(payload: bytes):
+    """Inverse of encode_rle_payload, returns (image_size, [(score, counts)])."""
+    if payload[:4] != RLE_MAGIC:
+        raise ValueError("Not an RLE mask payload")
+    h, w, n = struct.unpack_from("<III", payload, 4)
+    offset, masks = 16, []
+    for _ in range(n):
+        score, n_counts = struct.unpack_from("<fI", payload, offset)
+        offset += 8
+        counts = np.frombuffer(payload, dtype="<u4", count=n_counts, offset=offset)
+        offset += 4 * n_counts
+        masks.append((score, counts))
+    return (h, w), masks
+
+
+def palette(n: int, alpha: int = 200) -> np.ndarray:
+    """
+    Deterministic RGBA colours for labels 0..n, label 0 being transparent.
+    Hues step by the golden ratio, matching paletteColor in the client.
+    """
+    h = (np.arange(n) * 0.618033988749895) % 1
+    s, v = 0.65, 0.95
+    i = np.floor(h * 6).astype(np.int64) % 6
+    f = h * 6 - np.floor(h * 6)
+    p, q, t = v * (1 - s), v * (1 - f * s), v * (1 - (1 - f) * s)
+    vv, pp = np.full(n, v), np.full(n, p)
+    choices = [(vv, t, pp), (q, vv, pp), (pp, vv, t), (pp, q, vv), (t, pp, vv), (vv, pp, q)]
+    rgb = np.stack([np.choose(i, channel) for channel in zip(*choices)], axis=-1)
+    out = np.zeros((n + 1, 4), dtype=np.uint8)
+    out[1:, :3] = np.floor(rgb * 255 + 0.5)
+    out[1:, 3] = alpha
+    return out
+
+
+def rle_foreground_indices(counts) -> np.ndarray:
+    """Column-major flat indices of the foreground pixels of an uncompressed RLE."""
+    counts = np.asarray(counts, dtype=np.int64)
+    starts = (np.cumsum(counts) - counts)[1::2]
+    lengths = counts[1::2]
+    # Concatenated aranges: start of each run repeated over its length, plus offsets
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(starts, lengths) + offsets
+
+
+def label_map(masks, image_size) -> np.ndarray:
+    """
+    uint16 map where pixel value i + 1 means mask i covers it, later masks on
+    top. Segmentations can be uncompressed RLEs or boolean HxW arrays; RLEs
+    are written in column-major order straight into a single allocation, so
+    the cost is O(H*W + total mask area).
+    """
+    h, w = image_size
+    labels_t = np.zeros((w, h), dtype=np.uint16)
+    flat = labels_t.reshape(-1)
+    for i, mi in enumerate(masks):
+        seg = mi["segmentation"]
+        if isinstance(seg, dict):
+            flat[rle_foreground_indices(seg["counts"])] = i + 1
+        else:
+            labels_t.T[np.asarray(seg)] = i + 1
+    return labels_t.T
+
+
+def composite(labels: np.ndarray, n: int, alpha: int = 200) -> np.ndarray:
+    """RGBA overlay of a label map using the deterministic palette."""
+    return palette(n, alpha)[labels]
+
+
+def encode_label_map_png(masks, image_size) -> bytes:
+    buf = io.BytesIO()
+    labels = np.ascontiguousarray(label_map(masks, image_size))
+    PILImage.fromarray(labels).save(buf, format="PNG")
+    return buf.getvalue()
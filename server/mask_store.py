@@ -0,0 +1,52 @@
+import secrets, threading
+from collections import OrderedDict
+
+
+class HandleStore:
+    """
+    Byte-bounded LRU of server-side objects (masks, renders) addressed by
+    short random IDs, so clients can refer to them instead of re-uploading.
+    """
+
+    def __init__(self, max_bytes: int, prefix: str = ""):
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, value, nbytes: int) -> str:
+        handle = self.prefix + secrets.token_urlsafe(6)
+        with self._lock:
+            self._entries[handle] = (value, nbytes)
+            self.nbytes += nbytes
+            self._evict()
+        return handle
+
+    def get(self, handle: str):
+        with self._lock:
+            entry = self._entries.get(handle)
+            if entry is None:
+                return None
+            self._entries.move_to_end(handle)
+            return entry[0]
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.nbytes, "max_bytes": self.max_bytes}
+
+    def resize(self, handle: str, nbytes: int):
+        """Updates the accounted size of an entry that grew or shrank in place."""
+        with self._lock:
+            entry = self._entries.get(handle)
+            if entry is None:
+                return
+            self._entries[handle] = (entry[0], nbytes)
+            self._entries.move_to_end(handle)
+            self.nbytes += nbytes - entry[1]
+            self._evict()
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self.nbytes -= evicted
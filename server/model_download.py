@@ -0,0 +1,173 @@
+import hashlib, os
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+CHUNK_BYTES = 8 << 20
+
+
+class DownloadError(RuntimeError):
+    pass
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_BYTES), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _probe(session, url, timeout):
+    """(total size or None, whether byte ranges are served)"""
+    r = session.get(url, headers={"Range": "bytes=0-0"}, stream=True, timeout=timeout)
+    with r:
+        r.raise_for_status()
+        if r.status_code == 206 and "/" in r.headers.get("Content-Range", ""):
+            total = r.headers["Content-Range"].rsplit("/", 1)[1]
+            if total.isdigit():
+                return int(total), True
+        length = r.headers.get("Content-Length")
+        return (int(length) if length and r.status_code == 200 else None), False
+
+
+def _fetch_segment(session, url, part, start, end, timeout, retries):
+    """
+    Appends bytes [start, end] (inclusive, end None for "to the end") of `url`
+    to `part`, resuming from what the file already holds.
+    """
+    for attempt in range(retries + 1):
+        have = os.path.getsize(part) if os.path.exists(part) else 0
+        if end is not None and start + have > end:
+            return
+        headers = {}
+        if have or end is not None:
+            headers["Range"] = f"bytes={start + have}-{'' if end is None else end}"
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=timeout) as r:
+                r.raise_for_status()
+                restart = headers and r.status_code != 206
+                if restart and start > 0:
+                    raise DownloadError("Server ignored the byte range")
+                # A server without range support resends the whole file
+                with open(part, "wb" if restart else "ab") as f:
+                    for chunk in r.iter_content(CHUNK_BYTES):
+                        f.write(chunk)
+            if end is None or os.path.getsize(part) == end - start + 1:
+                return
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError):
+            if attempt == retries:
+                raise
+    raise DownloadError(f"Incomplete segment {part}")
+
+
+def download_file(url, dest, sha256=None, parallel=4, timeout=60, retries=3, session=None):
+    """
+    Downloads `url` to `dest` unless a verified copy is already there, and
+    returns `dest`.
+
+    The file is split into up to `parallel` byte ranges fetched concurrently
+    into `<dest>.part-<start>-<end>` files, which later runs resume from if
+    the process dies. Once complete the parts are joined, the size and the
+    SHA-256 (if given) are checked, and the result is renamed into place, so
+    `dest` never holds a partial file. The digest is recorded next to it in
+    `<dest>.sha256`. A `dest` without that record (e.g. from an older
+    downloader) is checked against the server's size first, and hashed only
+    if there is a `sha256` to compare it with.
+    """
+    session = session or requests.Session()
+    marker = dest + ".sha256"
+    if os.path.exists(dest):
+        if os.path.exists(marker):
+            with open(marker) as f:
+                recorded = f.read().strip()
+            if not sha256 or recorded == sha256.lower():
+                return dest
+        try:
+            total, _ = _probe(session, url, timeout)
+        except requests.RequestException:
+            # Offline: keep what we have rather than failing to start
+            return dest
+        if total is None or os.path.getsize(dest) == total:
+            if not sha256 or _verify(dest, sha256, marker):
+                return dest
+        os.remove(dest)
+
+    directory = os.path.dirname(os.path.abspath(dest))
+    os.makedirs(directory, exist_ok=True)
+    total, ranged = _probe(session, url, timeout)
+    if ranged and total:
+        n = max(1, min(parallel, total // CHUNK_BYTES))
+        bounds = [total * i // n for i in range(n + 1)]
+        segments = [(bounds[i], bounds[i + 1] - 1) for i in range(n)]
+    else:
+        segments = [(0, None)]
+    parts = [f"{dest}.part-{start}-{'' if end is None else end}" for start, end in segments]
+
+    # Parts from a different split (or a server without ranges) cannot be resumed
+    prefix = os.path.basename(dest) + ".part-"
+    keep = {os.path.basename(part) for part in parts} if ranged else set()
+    for name in os.listdir(directory):
+        if name.startswith(prefix) and name not in keep:
+            os.remove(os.path.join(directory, name))
+
+    with ThreadPoolExecutor(len(segments)) as pool:
+        jobs = [pool.submit(_fetch_segment, session, url, part, start, end, timeout, retries)
+                for part, (start, end) in zip(parts, segments)]
+        for job in jobs:
+            job.result()
+
+    tmp = dest + ".tmp"
+    h = hashlib.sha256()
+    with open(tmp, "wb") as out:
+        for part in parts:
+            with open(part, "rb") as f:
+                for chunk in iter(lambda: f.read(CHUNK_BYTES), b""):
+                    h.update(chunk)
+                    out.write(chunk)
+    digest = h.hexdigest()
+    size = os.path.getsize(tmp)
+    if (total is not None and size != total) or (sha256 and digest != sha256.lower()):
+        os.remove(tmp)
+        for part in parts:
+            os.remove(part)
+        raise DownloadError(f"Downloaded {url} does not match the expected size or SHA-256")
+    os.replace(tmp, dest)
+    with open(marker, "w") as f:
+        f.write(digest)
+    for part in parts:
+        os.remove(part)
+    return dest
+
+
+def _verify(path, sha256, marker):
+    digest = _sha256(path)
+    if sha256 and digest != sha256.lower():
+        return False
+    with open(marker, "w") as f:
+        f.write(digest)
+    return True
+
+
+def record_digest(path):
+    """Hashes `path` and records the digest in `<path>.sha256`, as download_file does."""
+    _verify(path, None, path + ".sha256")
+
+
+def checkpoint_version(path):
+    """
+    Identifies the contents of a file: the digest recorded in
+    `<path>.sha256`, unless the file is newer than that record, else its
+    size and modification time.
+    """
+    marker = path + ".sha256"
+    st = os.stat(path)
+    if os.path.exists(marker) and os.path.getmtime(marker) >= st.st_mtime:
+        with open(marker) as f:
+            return f.read().strip()[:16]
+    return f"{st.st_size:x}-{st.st_mtime_ns:x}"
+
+
+def exported_weights_path(checkpoint):
+    """Where export_weights.py puts the safetensors export of `checkpoint`."""
+    return f"{os.path.splitext(checkpoint)[0]}.{checkpoint_version(checkpoint)}.safetensors"
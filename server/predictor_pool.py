@@ -0,0 +1,34 @@
+import queue
+from contextlib import contextmanager
+
+
+class PredictorPool:
+    """
+    A fixed set of stateful predictors built by `factory`, typically
+    SAM2ImagePredictor or SAM2AutomaticMaskGenerator instances wrapping one
+    shared SAM2Base. Each request checks one out for its whole
+    set_image/predict sequence, so concurrent requests never see each
+    other's per-image state while the model weights are loaded only once.
+    """
+
+    def __init__(self, factory, size: int):
+        if size < 1:
+            raise ValueError("Pool size must be at least 1")
+        self.size = size
+        self._free = queue.LifoQueue()
+        for _ in range(size):
+            self._free.put(factory())
+
+    @contextmanager
+    def checkout(self, timeout=None):
+        try:
+            item = self._free.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError("No predictor became available")
+        try:
+            yield item
+        finally:
+            self._free.put(item)
+
+    def stats(self):
+        return {"size": self.size, "available": self._free.qsize()}
@@ -5,7 +5,7 @@
 # LICENSE file in the root directory of this source tree.
 
 # Adapted from https://github.com/facebookresearch/segment-anything/blob/main/segment_anything/automatic_mask_generator.py
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import numpy as np
 import torch
@@ -14,7 +14,6 @@ from torchvision.ops.boxes import batched_nms, box_area  # type: ignore
 from sam2.modeling.sam2_base import SAM2Base
 from sam2.sam2_image_predictor import SAM2ImagePredictor
 from sam2.utils.amg import (
-    area_from_rle,
     batch_iterator,
     batched_mask_to_box,
     box_xyxy_to_xywh,
@@ -23,14 +22,14 @@ from sam2.utils.amg import (
     coco_encode_rle,
     generate_crop_boxes,
     is_box_near_crop_edge,
-    mask_to_rle_pytorch,
     MaskData,
     remove_small_regions,
-    rle_to_mask,
+    RLEBatch,
     uncrop_boxes_xyxy,
     uncrop_masks,
     uncrop_points,
 )
+from sam2.utils.rle_ops import mask_nms
 
 
 class SAM2AutomaticMaskGenerator:
@@ -53,6 +52,9 @@ class SAM2AutomaticMaskGenerator:
         output_mode: str = "binary_mask",
         use_m2m: bool = False,
         multimask_output: bool = True,
+        precision: str = "fp32",
+        crop_batch_size: int = 8,
+        crop_mask_nms: bool = False,
         **kwargs,
     ) -> None:
         """
@@ -101,6 +103,13 @@ class SAM2AutomaticMaskGenerator:
             memory.
           use_m2m (bool): Whether to add a one step refinement using previous mask predictions.
           multimask_output (bool): Whether to output multimask at each point of the grid.
+          precision (str): The inference precision of the underlying
+            SAM2ImagePredictor, one of 'fp32', 'bf16' or 'fp16'.
+          crop_batch_size (int): The number of image crops encoded together
+            in one backbone pass. Higher numbers keep the GPU busier but use
+            more memory; 1 encodes every crop on its own.
+          crop_mask_nms (bool): If true, duplicate masks between crops are
+            removed by mask IoU, computed on the RLEs, instead of box IoU.
         """
 
         assert (points_per_side is None) != (
@@ -133,6 +142,7 @@ class SAM2AutomaticMaskGenerator:
             model,
             max_hole_area=min_mask_region_area,
             max_sprinkle_area=min_mask_region_area,
+            precision=precision,
         )
         self.points_per_batch = points_per_batch
         self.pred_iou_thresh = pred_iou_thresh
@@ -148,6 +158,9 @@ class SAM2AutomaticMaskGenerator:
         self.output_mode = output_mode
         self.use_m2m = use_m2m
         self.multimask_output = multimask_output
+        self.crop_batch_size = crop_batch_size
+        self.crop_mask_nms = crop_mask_nms
+        self._image_state = None
 
     @classmethod
     def from_pretrained(cls, model_id: str, **kwargs) -> "SAM2AutomaticMaskGenerator":
@@ -167,12 +180,21 @@ class SAM2AutomaticMaskGenerator:
         return cls(sam_model, **kwargs)
 
     @torch.no_grad()
-    def generate(self, image: np.ndarray) -> List[Dict[str, Any]]:
+    def generate(
+        self,
+        image: np.ndarray,
+        on_crop: Optional[Callable[[int, int, List[Dict[str, Any]]], None]] = None,
+    ) -> List[Dict[str, Any]]:
         """
         Generates masks for the given image.
 
         Arguments:
           image (np.ndarray): The image to generate masks for, in HWC uint8 format.
+          on_crop (callable or None): If given, called as
+            on_crop(crop_idx, n_crops, records) as soon as each crop is done,
+            with the records of that crop in the format returned below. These
+            are not yet deduplicated against other crops, so the same object
+            may appear in several calls; the return value is the final set.
 
         Returns:
            list(dict(str, any)): A list over records for masks. Each record is
@@ -193,24 +215,26 @@ class SAM2AutomaticMaskGenerator:
         """
 
         # Generate masks
-        mask_data = self._generate_masks(image)
+        mask_data = self._generate_masks(image, on_crop)
+        return self._mask_records(mask_data)
 
+    def _mask_records(self, mask_data: MaskData) -> List[Dict[str, Any]]:
         # Encode masks
+        rles = mask_data["rles"]
         if self.output_mode == "coco_rle":
-            mask_data["segmentations"] = [
-                coco_encode_rle(rle) for rle in mask_data["rles"]
-            ]
+            segmentations = [coco_encode_rle(rle) for rle in rles.to_list()]
         elif self.output_mode == "binary_mask":
-            mask_data["segmentations"] = [rle_to_mask(rle) for rle in mask_data["rles"]]
+            segmentations = list(rles.to_masks())
         else:
-            mask_data["segmentations"] = mask_data["rles"]
+            segmentations = rles.to_list()
+        areas = rles.area()
 
         # Write mask records
         curr_anns = []
-        for idx in range(len(mask_data["segmentations"])):
+        for idx in range(len(segmentations)):
             ann = {
-                "segmentation": mask_data["segmentations"][idx],
-                "area": area_from_rle(mask_data["rles"][idx]),
+                "segmentation": segmentations[idx],
+                "area": int(areas[idx]),
                 "bbox": box_xyxy_to_xywh(mask_data["boxes"][idx]).tolist(),
                 "predicted_iou": mask_data["iou_preds"][idx].item(),
                 "point_coords": [mask_data["points"][idx].tolist()],
@@ -221,45 +245,97 @@ class SAM2AutomaticMaskGenerator:
 
         return curr_anns
 
-    def _generate_masks(self, image: np.ndarray) -> MaskData:
+    def get_image_state(self) -> Optional[Dict[str, Any]]:
+        """
+        Returns the predictor state (see SAM2ImagePredictor.get_image_state) of
+        the uncropped image from the last call to 'generate', so the image
+        embedding computed there can be reused for interactive prediction.
+        Returns None if no image has been processed yet.
+        """
+        return self._image_state
+
+    def _generate_masks(
+        self,
+        image: np.ndarray,
+        on_crop: Optional[Callable[[int, int, List[Dict[str, Any]]], None]] = None,
+    ) -> MaskData:
         orig_size = image.shape[:2]
+        self._image_state = None
         crop_boxes, layer_idxs = generate_crop_boxes(
             orig_size, self.crop_n_layers, self.crop_overlap_ratio
         )
 
-        # Iterate over image crops
+        # Iterate over image crops, encoding up to crop_batch_size of them at once
         data = MaskData()
-        for crop_box, layer_idx in zip(crop_boxes, layer_idxs):
-            crop_data = self._process_crop(image, crop_box, layer_idx, orig_size)
-            data.cat(crop_data)
+        batch_size = max(1, self.crop_batch_size)
+        for start in range(0, len(crop_boxes), batch_size):
+            batch_boxes = crop_boxes[start : start + batch_size]
+            self.predictor.set_image_batch(
+                [image[y0:y1, x0:x1, :] for x0, y0, x1, y1 in batch_boxes]
+            )
+            if start == 0:
+                # Keep the embedding of the full image, it is valid for any predictor
+                self._image_state = self._single_image_state(0)
+            for img_idx, crop_box in enumerate(batch_boxes):
+                crop_idx = start + img_idx
+                crop_data = self._process_crop(
+                    crop_box, layer_idxs[crop_idx], orig_size, img_idx
+                )
+                if on_crop is not None:
+                    on_crop(crop_idx, len(crop_boxes), self._mask_records(crop_data))
+                data.cat(crop_data)
+            self.predictor.reset_predictor()
 
         # Remove duplicate masks between crops
         if len(crop_boxes) > 1:
             # Prefer masks from smaller crops
             scores = 1 / box_area(data["crop_boxes"])
-            scores = scores.to(data["boxes"].device)
-            keep_by_nms = batched_nms(
-                data["boxes"].float(),
-                scores,
-                torch.zeros_like(data["boxes"][:, 0]),  # categories
-                iou_threshold=self.crop_nms_thresh,
-            )
+            if self.crop_mask_nms:
+                keep_by_nms = torch.as_tensor(
+                    mask_nms(data["rles"], scores.numpy(), self.crop_nms_thresh)
+                )
+            else:
+                scores = scores.to(data["boxes"].device)
+                keep_by_nms = batched_nms(
+                    data["boxes"].float(),
+                    scores,
+                    torch.zeros_like(data["boxes"][:, 0]),  # categories
+                    iou_threshold=self.crop_nms_thresh,
+                )
             data.filter(keep_by_nms)
         data.to_numpy()
         return data
 
+    def _single_image_state(self, img_idx: int) -> Dict[str, Any]:
+        """
+        The predictor state of one image of the batch set by set_image_batch,
+        as if it had been set on its own. The features are copied so the
+        state does not keep the rest of the batch alive.
+        """
+        state = self.predictor.get_image_state()
+        features = state["features"]
+        return {
+            "features": {
+                "image_embed": features["image_embed"][img_idx : img_idx + 1].clone(),
+                "high_res_feats": [
+                    feat[img_idx : img_idx + 1].clone()
+                    for feat in features["high_res_feats"]
+                ],
+            },
+            "orig_hw": [state["orig_hw"][img_idx]],
+            "is_batch": False,
+        }
+
     def _process_crop(
         self,
-        image: np.ndarray,
         crop_box: List[int],
         crop_layer_idx: int,
         orig_size: Tuple[int, ...],
+        img_idx: int,
     ) -> MaskData:
-        # Crop the image and calculate embeddings
+        # The crop was encoded as image img_idx of the predictor's batch
         x0, y0, x1, y1 = crop_box
-        cropped_im = image[y0:y1, x0:x1, :]
-        cropped_im_size = cropped_im.shape[:2]
-        self.predictor.set_image(cropped_im)
+        cropped_im_size = (y1 - y0, x1 - x0)
 
         # Get points for this crop
         points_scale = np.array(cropped_im_size)[None, ::-1]
@@ -269,11 +345,15 @@ class SAM2AutomaticMaskGenerator:
         data = MaskData()
         for (points,) in batch_iterator(self.points_per_batch, points_for_image):
             batch_data = self._process_batch(
-                points, cropped_im_size, crop_box, orig_size, normalize=True
+                points,
+                cropped_im_size,
+                crop_box,
+                orig_size,
+                normalize=True,
+                img_idx=img_idx,
             )
             data.cat(batch_data)
             del batch_data
-        self.predictor.reset_predictor()
 
         # Remove duplicates within this crop.
         keep_by_nms = batched_nms(
@@ -287,7 +367,7 @@ class SAM2AutomaticMaskGenerator:
         # Return to the original image frame
         data["boxes"] = uncrop_boxes_xyxy(data["boxes"], crop_box)
         data["points"] = uncrop_points(data["points"], crop_box)
-        data["crop_boxes"] = torch.tensor([crop_box for _ in range(len(data["rles"]))])
+        data["crop_boxes"] = torch.tensor([crop_box]).repeat(len(data["rles"]), 1)
 
         return data
 
@@ -298,6 +378,7 @@ class SAM2AutomaticMaskGenerator:
         crop_box: List[int],
         orig_size: Tuple[int, ...],
         normalize=False,
+        img_idx: int = -1,
     ) -> MaskData:
         orig_h, orig_w = orig_size
 
@@ -316,6 +397,7 @@ class SAM2AutomaticMaskGenerator:
             in_labels[:, None],
             multimask_output=self.multimask_output,
             return_logits=True,
+            img_idx=img_idx,
         )
 
         # Serialize predictions and store in MaskData
@@ -349,7 +431,11 @@ class SAM2AutomaticMaskGenerator:
                 in_points.shape[0], dtype=torch.int, device=in_points.device
             )
             masks, ious = self.refine_with_m2m(
-                in_points, labels, data["low_res_masks"], self.points_per_batch
+                in_points,
+                labels,
+                data["low_res_masks"],
+                self.points_per_batch,
+                img_idx=img_idx,
             )
             data["masks"] = masks.squeeze(1)
             data["iou_preds"] = ious.squeeze(1)
@@ -378,7 +464,7 @@ class SAM2AutomaticMaskGenerator:
 
         # Compress to RLE
         data["masks"] = uncrop_masks(data["masks"], crop_box, orig_h, orig_w)
-        data["rles"] = mask_to_rle_pytorch(data["masks"])
+        data["rles"] = RLEBatch.from_masks(data["masks"])
         del data["masks"]
 
         return data
@@ -395,15 +481,14 @@ class SAM2AutomaticMaskGenerator:
 
         Requires open-cv as a dependency.
         """
-        if len(mask_data["rles"]) == 0:
+        rles = mask_data["rles"]
+        if len(rles) == 0:
             return mask_data
 
         # Filter small disconnected regions and holes
         new_masks = []
         scores = []
-        for rle in mask_data["rles"]:
-            mask = rle_to_mask(rle)
-
+        for mask in rles.to_masks():
             mask, changed = remove_small_regions(mask, min_area, mode="holes")
             unchanged = not changed
             mask, changed = remove_small_regions(mask, min_area, mode="islands")
@@ -424,17 +509,23 @@ class SAM2AutomaticMaskGenerator:
             iou_threshold=nms_thresh,
         )
 
-        # Only recalculate RLEs for masks that have changed
-        for i_mask in keep_by_nms:
-            if scores[i_mask] == 0.0:
-                mask_torch = masks[i_mask].unsqueeze(0)
-                mask_data["rles"][i_mask] = mask_to_rle_pytorch(mask_torch)[0]
-                mask_data["boxes"][i_mask] = boxes[i_mask]  # update res directly
+        # Only recalculate RLEs for masks that have changed, appending them
+        # after the old ones and picking them instead of their originals
+        keep = keep_by_nms.cpu().numpy()
+        changed = np.asarray(scores)[keep] == 0.0
+        for i_mask in keep[changed]:
+            mask_data["boxes"][i_mask] = boxes[i_mask]  # update res directly
+        order = keep.copy()
+        order[changed] = len(rles) + np.arange(changed.sum())
+        rles = rles.cat(RLEBatch.from_masks(masks[keep[changed]]))
         mask_data.filter(keep_by_nms)
+        mask_data["rles"] = rles.filter(order)
 
         return mask_data
 
-    def refine_with_m2m(self, points, point_labels, low_res_masks, points_per_batch):
+    def refine_with_m2m(
+        self, points, point_labels, low_res_masks, points_per_batch, img_idx=-1
+    ):
         new_masks = []
         new_iou_preds = []
 
@@ -447,6 +538,7 @@ class SAM2AutomaticMaskGenerator:
                 mask_input=low_res_mask[:, None, :],
                 multimask_output=False,
                 return_logits=True,
+                img_idx=img_idx,
             )
             new_masks.append(best_masks)
             new_iou_preds.append(best_iou_preds)
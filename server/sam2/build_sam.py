@@ -4,8 +4,10 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import hashlib
 import logging
 import os
+import tempfile
 
 import torch
 from hydra import compose
@@ -75,9 +77,20 @@ def build_sam2(
     mode="eval",
     hydra_overrides_extra=[],
     apply_postprocessing=True,
+    config_cache_dir=None,
     **kwargs,
 ):
-
+    """
+    Builds a SAM 2 model from a Hydra config and loads `ckpt_path` into it,
+    which may be a `.pt` checkpoint or a `.safetensors` export of one (see
+    export_safetensors). The modules are created directly on `device` and
+    the weights are memory-mapped and copied there once, without first
+    materializing a full CPU copy of the model.
+
+    If `config_cache_dir` is given, the resolved config is saved there on
+    first use, keyed by the config's name, contents and overrides, and later
+    builds load it directly instead of running Hydra composition.
+    """
     if apply_postprocessing:
         hydra_overrides_extra = hydra_overrides_extra.copy()
         hydra_overrides_extra += [
@@ -87,9 +100,9 @@ def build_sam2(
             "++model.sam_mask_decoder_extra_args.dynamic_multimask_stability_thresh=0.98",
         ]
     # Read config and init model
-    cfg = compose(config_name=config_file, overrides=hydra_overrides_extra)
-    OmegaConf.resolve(cfg)
-    model = instantiate(cfg.model, _recursive_=True)
+    cfg = _resolved_config(config_file, hydra_overrides_extra, config_cache_dir)
+    with torch.device(device):
+        model = instantiate(cfg.model, _recursive_=True)
     _load_checkpoint(model, ckpt_path)
     model = model.to(device)
     if mode == "eval":
@@ -161,9 +174,58 @@ def build_sam2_video_predictor_hf(model_id, **kwargs):
     )
 
 
+def _resolved_config(config_file, overrides, cache_dir=None):
+    if cache_dir is None:
+        cfg = compose(config_name=config_file, overrides=overrides)
+        OmegaConf.resolve(cfg)
+        return cfg
+    # Keyed on the YAML contents too, so an edited config is resolved again
+    source = os.path.join(sam2.__path__[0], config_file)
+    if not source.endswith(".yaml"):
+        source += ".yaml"
+    with open(source, "rb") as f:
+        content = hashlib.sha256(f.read()).hexdigest()
+    key = hashlib.sha256(
+        "\n".join([config_file, content, *overrides]).encode()
+    ).hexdigest()[:16]
+    path = os.path.join(cache_dir, f"{os.path.basename(config_file)}.{key}.resolved.yaml")
+    if os.path.exists(path):
+        return OmegaConf.load(path)
+    cfg = compose(config_name=config_file, overrides=overrides)
+    OmegaConf.resolve(cfg)
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        f.write(OmegaConf.to_yaml(cfg))
+    os.replace(tmp, path)
+    return cfg
+
+
+def export_safetensors(ckpt_path, out_path):
+    """
+    Writes the model weights of a `.pt` checkpoint to a `.safetensors` file,
+    which loads by memory-mapping instead of unpickling. Requires the
+    optional `safetensors` package.
+    """
+    from safetensors.torch import save_file
+
+    sd = torch.load(ckpt_path, map_location="cpu", weights_only=True, mmap=True)["model"]
+    tmp = out_path + ".tmp"
+    save_file({k: v.contiguous() for k, v in sd.items()}, tmp)
+    os.replace(tmp, out_path)
+
+
 def _load_checkpoint(model, ckpt_path):
     if ckpt_path is not None:
-        sd = torch.load(ckpt_path, map_location="cpu", weights_only=True)["model"]
+        if ckpt_path.endswith(".safetensors"):
+            from safetensors.torch import load_file
+
+            device = next(model.parameters()).device
+            sd = load_file(ckpt_path, device=str(device))
+        else:
+            sd = torch.load(
+                ckpt_path, map_location="cpu", weights_only=True, mmap=True
+            )["model"]
         missing_keys, unexpected_keys = model.load_state_dict(sd)
         if missing_keys:
             logging.error(missing_keys)
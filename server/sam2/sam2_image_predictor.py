@@ -5,8 +5,9 @@
 # LICENSE file in the root directory of this source tree.
 
 import logging
+from contextlib import nullcontext
 
-from typing import List, Optional, Tuple, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import numpy as np
 import torch
@@ -16,6 +17,9 @@ from sam2.modeling.sam2_base import SAM2Base
 
 from sam2.utils.transforms import SAM2Transforms
 
+# Autocast dtypes for the supported inference precisions
+PRECISIONS = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
 
 class SAM2ImagePredictor:
     def __init__(
@@ -24,6 +28,7 @@ class SAM2ImagePredictor:
         mask_threshold=0.0,
         max_hole_area=0.0,
         max_sprinkle_area=0.0,
+        precision="fp32",
         **kwargs,
     ) -> None:
         """
@@ -38,9 +43,19 @@ class SAM2ImagePredictor:
             the maximum area of max_hole_area in low_res_masks.
           max_sprinkle_area (int): If max_sprinkle_area > 0, we remove small sprinkles up to
             the maximum area of max_sprinkle_area in low_res_masks.
+          precision (str): One of 'fp32', 'bf16' or 'fp16'. Anything but 'fp32'
+            runs the image encoder and the mask decoder under torch.autocast
+            with that dtype; the weights stay in fp32 and the returned masks,
+            scores and logits are always fp32. 'bf16' also works on CPU,
+            'fp16' is meant for GPUs without bf16 support.
         """
         super().__init__()
+        if precision not in PRECISIONS:
+            raise ValueError(
+                f"Unknown precision {precision}, expected one of {list(PRECISIONS)}"
+            )
         self.model = sam_model
+        self.precision = precision
         self._transforms = SAM2Transforms(
             resolution=self.model.image_size,
             mask_threshold=mask_threshold,
@@ -114,11 +129,12 @@ class SAM2ImagePredictor:
             len(input_image.shape) == 4 and input_image.shape[1] == 3
         ), f"input_image must be of size 1x3xHxW, got {input_image.shape}"
         logging.info("Computing image embeddings for the provided image...")
-        backbone_out = self.model.forward_image(input_image)
-        _, vision_feats, _, _ = self.model._prepare_backbone_features(backbone_out)
-        # Add no_mem_embed, which is added to the lowest rest feat. map during training on videos
-        if self.model.directly_add_no_mem_embed:
-            vision_feats[-1] = vision_feats[-1] + self.model.no_mem_embed
+        with self._autocast():
+            backbone_out = self.model.forward_image(input_image)
+            _, vision_feats, _, _ = self.model._prepare_backbone_features(backbone_out)
+            # Add no_mem_embed, which is added to the lowest rest feat. map during training on videos
+            if self.model.directly_add_no_mem_embed:
+                vision_feats[-1] = vision_feats[-1] + self.model.no_mem_embed
 
         feats = [
             feat.permute(1, 2, 0).view(1, -1, *feat_size)
@@ -157,11 +173,12 @@ class SAM2ImagePredictor:
             len(img_batch.shape) == 4 and img_batch.shape[1] == 3
         ), f"img_batch must be of size Bx3xHxW, got {img_batch.shape}"
         logging.info("Computing image embeddings for the provided images...")
-        backbone_out = self.model.forward_image(img_batch)
-        _, vision_feats, _, _ = self.model._prepare_backbone_features(backbone_out)
-        # Add no_mem_embed, which is added to the lowest rest feat. map during training on videos
-        if self.model.directly_add_no_mem_embed:
-            vision_feats[-1] = vision_feats[-1] + self.model.no_mem_embed
+        with self._autocast():
+            backbone_out = self.model.forward_image(img_batch)
+            _, vision_feats, _, _ = self.model._prepare_backbone_features(backbone_out)
+            # Add no_mem_embed, which is added to the lowest rest feat. map during training on videos
+            if self.model.directly_add_no_mem_embed:
+                vision_feats[-1] = vision_feats[-1] + self.model.no_mem_embed
 
         feats = [
             feat.permute(1, 2, 0).view(batch_size, -1, *feat_size)
@@ -403,29 +420,33 @@ class SAM2ImagePredictor:
             else:
                 concat_points = (box_coords, box_labels)
 
-        sparse_embeddings, dense_embeddings = self.model.sam_prompt_encoder(
-            points=concat_points,
-            boxes=None,
-            masks=mask_input,
-        )
+        with self._autocast():
+            sparse_embeddings, dense_embeddings = self.model.sam_prompt_encoder(
+                points=concat_points,
+                boxes=None,
+                masks=mask_input,
+            )
 
-        # Predict masks
-        batched_mode = (
-            concat_points is not None and concat_points[0].shape[0] > 1
-        )  # multi object prediction
-        high_res_features = [
-            feat_level[img_idx].unsqueeze(0)
-            for feat_level in self._features["high_res_feats"]
-        ]
-        low_res_masks, iou_predictions, _, _ = self.model.sam_mask_decoder(
-            image_embeddings=self._features["image_embed"][img_idx].unsqueeze(0),
-            image_pe=self.model.sam_prompt_encoder.get_dense_pe(),
-            sparse_prompt_embeddings=sparse_embeddings,
-            dense_prompt_embeddings=dense_embeddings,
-            multimask_output=multimask_output,
-            repeat_image=batched_mode,
-            high_res_features=high_res_features,
-        )
+            # Predict masks
+            batched_mode = (
+                concat_points is not None and concat_points[0].shape[0] > 1
+            )  # multi object prediction
+            high_res_features = [
+                feat_level[img_idx].unsqueeze(0)
+                for feat_level in self._features["high_res_feats"]
+            ]
+            low_res_masks, iou_predictions, _, _ = self.model.sam_mask_decoder(
+                image_embeddings=self._features["image_embed"][img_idx].unsqueeze(0),
+                image_pe=self.model.sam_prompt_encoder.get_dense_pe(),
+                sparse_prompt_embeddings=sparse_embeddings,
+                dense_prompt_embeddings=dense_embeddings,
+                multimask_output=multimask_output,
+                repeat_image=batched_mode,
+                high_res_features=high_res_features,
+            )
+        # Upscaling, thresholding and scoring always happen in fp32
+        low_res_masks = low_res_masks.float()
+        iou_predictions = iou_predictions.float()
 
         # Upscale the masks to the original image resolution
         masks = self._transforms.postprocess_masks(
@@ -452,10 +473,49 @@ class SAM2ImagePredictor:
         ), "Features must exist if an image has been set."
         return self._features["image_embed"]
 
+    def get_image_state(self) -> Dict[str, Any]:
+        """
+        Returns the per-image state computed by 'set_image' or 'set_image_batch',
+        i.e. the backbone features and the original image sizes. The returned
+        state can be stored and later passed to 'set_image_state' to predict
+        on the same image again without re-running the image encoder.
+        """
+        if not self._is_image_set:
+            raise RuntimeError(
+                "An image must be set with .set_image(...) before its state can be read."
+            )
+        return {
+            "features": self._features,
+            "orig_hw": list(self._orig_hw),
+            "is_batch": self._is_batch,
+        }
+
+    def set_image_state(self, state: Dict[str, Any]) -> None:
+        """
+        Restores a state previously returned by 'get_image_state', allowing
+        masks to be predicted with the 'predict' method without recomputing
+        the image embeddings.
+
+        Arguments:
+          state (dict): The state returned by 'get_image_state'. The features
+            must live on the same device as the model.
+        """
+        self.reset_predictor()
+        self._features = state["features"]
+        self._orig_hw = list(state["orig_hw"])
+        self._is_batch = state.get("is_batch", False)
+        self._is_image_set = True
+
     @property
     def device(self) -> torch.device:
         return self.model.device
 
+    def _autocast(self):
+        dtype = PRECISIONS[self.precision]
+        if dtype is None:
+            return nullcontext()
+        return torch.autocast(self.device.type, dtype=dtype)
+
     def reset_predictor(self) -> None:
         """
         Resets the image embeddings and other state variables.
@@ -24,14 +24,14 @@ class MaskData:
     def __init__(self, **kwargs) -> None:
         for v in kwargs.values():
             assert isinstance(
-                v, (list, np.ndarray, torch.Tensor)
-            ), "MaskData only supports list, numpy arrays, and torch tensors."
+                v, (list, np.ndarray, torch.Tensor, RLEBatch)
+            ), "MaskData only supports list, numpy arrays, torch tensors and RLEBatch."
         self._stats = dict(**kwargs)
 
     def __setitem__(self, key: str, item: Any) -> None:
         assert isinstance(
-            item, (list, np.ndarray, torch.Tensor)
-        ), "MaskData only supports list, numpy arrays, and torch tensors."
+            item, (list, np.ndarray, torch.Tensor, RLEBatch)
+        ), "MaskData only supports list, numpy arrays, torch tensors and RLEBatch."
         self._stats[key] = item
 
     def __delitem__(self, key: str) -> None:
@@ -51,6 +51,8 @@ class MaskData:
                 self._stats[k] = v[torch.as_tensor(keep, device=v.device)]
             elif isinstance(v, np.ndarray):
                 self._stats[k] = v[keep.detach().cpu().numpy()]
+            elif isinstance(v, RLEBatch):
+                self._stats[k] = v.filter(keep)
             elif isinstance(v, list) and keep.dtype == torch.bool:
                 self._stats[k] = [a for i, a in enumerate(v) if keep[i]]
             elif isinstance(v, list):
@@ -66,6 +68,8 @@ class MaskData:
                 self._stats[k] = torch.cat([self._stats[k], v], dim=0)
             elif isinstance(v, np.ndarray):
                 self._stats[k] = np.concatenate([self._stats[k], v], axis=0)
+            elif isinstance(v, RLEBatch):
+                self._stats[k] = self._stats[k].cat(v)
             elif isinstance(v, list):
                 self._stats[k] = self._stats[k] + deepcopy(v)
             else:
@@ -106,47 +110,65 @@ def batch_iterator(batch_size: int, *args) -> Generator[List[Any], None, None]:
         yield [arg[b * batch_size : (b + 1) * batch_size] for arg in args]
 
 
-def mask_to_rle_pytorch(tensor: torch.Tensor) -> List[Dict[str, Any]]:
+def mask_to_rle_arrays(tensor: torch.Tensor) -> Tuple[np.ndarray, np.ndarray]:
     """
-    Encodes masks to an uncompressed RLE, in the format expected by
-    pycoco tools.
+    Encodes a batch of masks to uncompressed RLE in one vectorized pass.
+    Returns (counts, offsets): a single int32 array holding the counts of all
+    masks back to back, and offsets of length B+1 such that the counts of
+    mask i are counts[offsets[i] : offsets[i + 1]]. The counts follow the
+    format of mask_to_rle_pytorch. Only one copy to the host is made.
     """
     # Put in fortran order and flatten h,w
     b, h, w = tensor.shape
+    assert h * w < 2**31, "Masks too large for int32 counts"
     tensor = tensor.permute(0, 2, 1).flatten(1)
 
-    # Compute change indices
+    # Change indices, ordered by mask and then by position
     diff = tensor[:, 1:] ^ tensor[:, :-1]
-    change_indices = diff.nonzero()
-
-    # Encode run length
-    out = []
-    for i in range(b):
-        cur_idxs = change_indices[change_indices[:, 0] == i, 1]
-        cur_idxs = torch.cat(
-            [
-                torch.tensor([0], dtype=cur_idxs.dtype, device=cur_idxs.device),
-                cur_idxs + 1,
-                torch.tensor([h * w], dtype=cur_idxs.dtype, device=cur_idxs.device),
-            ]
-        )
-        btw_idxs = cur_idxs[1:] - cur_idxs[:-1]
-        counts = [] if tensor[i, 0] == 0 else [0]
-        counts.extend(btw_idxs.detach().cpu().tolist())
-        out.append({"size": [h, w], "counts": counts})
-    return out
+    rows, cols = diff.nonzero(as_tuple=True)
+    n_changes = torch.bincount(rows, minlength=b)
+
+    # Each change ends a run and the last run of a mask ends at h*w. Run ends
+    # of mask r start at index run_starts[r], so change j lands at j + r.
+    n_runs = n_changes + 1
+    run_starts = torch.cumsum(n_runs, 0) - n_runs
+    ends = torch.full((int(n_runs.sum()),), h * w, dtype=torch.long, device=rows.device)
+    ends[torch.arange(len(rows), device=rows.device) + rows] = cols + 1
+    begins = torch.cat([ends.new_zeros(1), ends[:-1]])
+    begins[run_starts] = 0
+    runs = ends - begins
+
+    # Masks that start with foreground get a leading zero-length run
+    lead = tensor[:, 0].long()
+    shift = torch.repeat_interleave(torch.cumsum(lead, 0), n_runs)
+    counts = ends.new_zeros(len(runs) + int(lead.sum()))
+    counts[torch.arange(len(runs), device=runs.device) + shift] = runs
+
+    host = torch.cat([n_runs + lead, counts]).cpu().numpy()
+    offsets = np.zeros(b + 1, dtype=np.int64)
+    np.cumsum(host[:b], out=offsets[1:])
+    return host[b:].astype(np.int32), offsets
+
+
+def mask_to_rle_pytorch(tensor: torch.Tensor) -> List[Dict[str, Any]]:
+    """
+    Encodes masks to an uncompressed RLE, in the format expected by
+    pycoco tools.
+    """
+    _, h, w = tensor.shape
+    counts, offsets = mask_to_rle_arrays(tensor)
+    return [
+        {"size": [h, w], "counts": counts[start:end].tolist()}
+        for start, end in zip(offsets[:-1], offsets[1:])
+    ]
 
 
 def rle_to_mask(rle: Dict[str, Any]) -> np.ndarray:
     """Compute a binary mask from an uncompressed RLE."""
     h, w = rle["size"]
-    mask = np.empty(h * w, dtype=bool)
-    idx = 0
-    parity = False
-    for count in rle["counts"]:
-        mask[idx : idx + count] = parity
-        idx += count
-        parity ^= True
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    # Runs alternate between background and foreground, background first
+    mask = np.repeat(np.arange(len(counts)) % 2 == 1, counts)
     mask = mask.reshape(w, h)
     return mask.transpose()  # Put in C order
 
@@ -155,6 +177,153 @@ def area_from_rle(rle: Dict[str, Any]) -> int:
     return sum(rle["counts"][1::2])
 
 
+class RLEBatch:
+    """
+    Uncompressed RLEs of a batch of masks of the same size, stored compactly:
+    the counts of all masks back to back in one int32 array, plus offsets
+    such that the counts of mask i are counts[offsets[i] : offsets[i + 1]].
+    Counts follow the format of mask_to_rle_pytorch (column-major, starting
+    with a background run). Batches are never modified in place, filter and
+    cat return new ones.
+    """
+
+    __slots__ = ("size", "counts", "offsets")
+
+    def __init__(self, size, counts: np.ndarray, offsets: np.ndarray) -> None:
+        self.size = (int(size[0]), int(size[1]))
+        self.counts = counts
+        self.offsets = offsets
+
+    @classmethod
+    def from_masks(cls, masks: torch.Tensor) -> "RLEBatch":
+        counts, offsets = mask_to_rle_arrays(masks)
+        return cls(masks.shape[1:], counts, offsets)
+
+    @classmethod
+    def from_rles(cls, rles: List[Dict[str, Any]], size=None) -> "RLEBatch":
+        """From uncompressed RLE dicts; size is only needed if rles is empty."""
+        offsets = np.zeros(len(rles) + 1, dtype=np.int64)
+        np.cumsum([len(rle["counts"]) for rle in rles], out=offsets[1:])
+        counts = np.zeros(offsets[-1], dtype=np.int32)
+        for rle, start in zip(rles, offsets):
+            counts[start : start + len(rle["counts"])] = rle["counts"]
+        return cls(rles[0]["size"] if rles else size, counts, offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> Dict[str, Any]:
+        counts = self.counts[self.offsets[i] : self.offsets[i + 1]]
+        return {"size": list(self.size), "counts": counts.tolist()}
+
+    def __iter__(self) -> Generator[Dict[str, Any], None, None]:
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    @property
+    def nbytes(self) -> int:
+        return self.counts.nbytes + self.offsets.nbytes
+
+    def to_list(self) -> List[Dict[str, Any]]:
+        """The RLEs as dicts with list counts, as returned by mask_to_rle_pytorch."""
+        counts = self.counts.tolist()
+        bounds = self.offsets.tolist()
+        return [
+            {"size": list(self.size), "counts": counts[start:end]}
+            for start, end in zip(bounds[:-1], bounds[1:])
+        ]
+
+    def _is_foreground(self, ids: np.ndarray) -> np.ndarray:
+        """Whether each count is a foreground run, given the mask index of each count."""
+        # Runs alternate between background and foreground within each mask
+        return (np.arange(len(self.counts)) - self.offsets[:-1][ids]) % 2 == 1
+
+    def foreground_runs(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        (mask index, start, length) of every foreground run, ordered by mask
+        and position. Starts are column-major pixel indices.
+        """
+        ids = np.repeat(np.arange(len(self)), self.lengths)
+        ends = np.zeros(len(self.counts) + 1, dtype=np.int64)
+        np.cumsum(self.counts, out=ends[1:])
+        starts = ends[:-1] - ends[self.offsets[:-1]][ids]
+        fg = self._is_foreground(ids)
+        return ids[fg], starts[fg], self.counts[fg].astype(np.int64)
+
+    def area(self) -> np.ndarray:
+        ids, _, lengths = self.foreground_runs()
+        return np.bincount(ids, weights=lengths, minlength=len(self)).astype(np.int64)
+
+    def to_mask(self, i: int) -> np.ndarray:
+        """The binary HxW mask of mask i."""
+        h, w = self.size
+        counts = self.counts[self.offsets[i] : self.offsets[i + 1]]
+        values = np.arange(len(counts)) % 2 == 1
+        return np.repeat(values, counts).reshape(w, h).transpose()
+
+    def to_masks(self) -> np.ndarray:
+        """
+        All masks as one BxHxW boolean array, decoded in a single np.repeat:
+        the counts of every mask add up to H*W, so the whole batch expands
+        into one buffer in column-major order.
+        """
+        h, w = self.size
+        fg = self._is_foreground(np.repeat(np.arange(len(self)), self.lengths))
+        masks = np.repeat(fg, self.counts).reshape(len(self), w, h)
+        return masks.transpose(0, 2, 1)  # Put in C order
+
+    def to_box(self) -> np.ndarray:
+        """
+        Bx4 boxes in XYXY format, as batched_mask_to_box computes them from
+        the decoded masks: inclusive pixel bounds, all zeros for empty masks.
+        """
+        h = self.size[0]
+        ids, starts, lengths = self.foreground_runs()
+        last = starts + lengths - 1
+        x0, x1 = starts // h, last // h
+        # A run that continues into the next column covers its top and bottom rows
+        spans = x1 > x0
+        y0 = np.where(spans, 0, starts % h)
+        y1 = np.where(spans, h - 1, last % h)
+        boxes = np.zeros((len(self), 4), dtype=np.int64)
+        nonempty = np.bincount(ids, minlength=len(self)) > 0
+        if nonempty.any():
+            first = np.searchsorted(ids, np.flatnonzero(nonempty))
+            boxes[nonempty] = np.stack(
+                [
+                    np.minimum.reduceat(x0, first),
+                    np.minimum.reduceat(y0, first),
+                    np.maximum.reduceat(x1, first),
+                    np.maximum.reduceat(y1, first),
+                ],
+                axis=1,
+            )
+        return boxes
+
+    def filter(self, keep) -> "RLEBatch":
+        """The masks selected by a boolean mask or an index array, in that order."""
+        if isinstance(keep, torch.Tensor):
+            keep = keep.detach().cpu().numpy()
+        keep = np.asarray(keep)
+        idx = np.flatnonzero(keep) if keep.dtype == bool else keep.astype(np.int64)
+        lengths = self.lengths[idx]
+        offsets = np.zeros(len(idx) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        gather = np.repeat(self.offsets[idx] - offsets[:-1], lengths)
+        gather += np.arange(offsets[-1])
+        return RLEBatch(self.size, self.counts[gather], offsets)
+
+    def cat(self, other: "RLEBatch") -> "RLEBatch":
+        assert self.size == other.size, "Can only concatenate RLEs of the same size."
+        counts = np.concatenate([self.counts, other.counts])
+        offsets = np.concatenate([self.offsets, other.offsets[1:] + self.offsets[-1]])
+        return RLEBatch(self.size, counts, offsets)
+
+
 def calculate_stability_score(
     masks: torch.Tensor, mask_threshold: float, threshold_offset: float
 ) -> torch.Tensor:
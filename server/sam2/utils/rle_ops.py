@@ -0,0 +1,159 @@
+"""
+Set operations on uncompressed RLEs (see RLEBatch in amg.py), computed on
+the runs without decoding any mask.
+
+Intersections use the coverage function of a batch: the number of
+foreground pixels before a given column-major index, which is a binary
+search over the runs. The overlap of a run [s, e) with a mask is then
+coverage(e) - coverage(s), so intersecting two masks costs
+O(runs * log(runs)) instead of O(H * W). Pairs whose boxes do not overlap
+are skipped entirely.
+"""
+
+from typing import Optional, Tuple
+
+import numpy as np
+
+from sam2.utils.amg import RLEBatch
+
+# Upper bound on the runs queried at once, to bound temporary memory
+_MAX_QUERIES = 1 << 22
+
+
+def area(rles: RLEBatch) -> np.ndarray:
+    """Foreground pixels of each mask."""
+    return rles.area()
+
+
+def boxes(rles: RLEBatch) -> np.ndarray:
+    """Bx4 XYXY boxes with inclusive bounds, zeros for empty masks."""
+    return rles.to_box()
+
+
+class _Coverage:
+    """
+    The foreground runs of a batch laid end to end, mask j shifted by
+    j * H * W, with the number of foreground pixels before each run.
+    """
+
+    def __init__(self, rles: RLEBatch):
+        h, w = rles.size
+        ids, starts, lengths = rles.foreground_runs()
+        self.hw = h * w
+        self.starts = starts + ids * self.hw
+        self.lengths = lengths
+        self.before = np.cumsum(lengths) - lengths
+
+    def __call__(self, x: np.ndarray) -> np.ndarray:
+        """Foreground pixels at stacked indices below x."""
+        if len(self.starts) == 0:
+            return np.zeros(len(x), dtype=np.int64)
+        k = np.searchsorted(self.starts, x, side="right") - 1
+        kk = np.maximum(k, 0)
+        covered = self.before[kk] + np.minimum(x - self.starts[kk], self.lengths[kk])
+        return np.where(k >= 0, covered, 0)
+
+
+def _candidates(a_boxes, a_area, b_boxes, b_area) -> np.ndarray:
+    """Pairs (i, j) of non-empty masks whose boxes overlap."""
+    overlap = (
+        (a_boxes[:, None, 0] <= b_boxes[None, :, 2])
+        & (b_boxes[None, :, 0] <= a_boxes[:, None, 2])
+        & (a_boxes[:, None, 1] <= b_boxes[None, :, 3])
+        & (b_boxes[None, :, 1] <= a_boxes[:, None, 3])
+    )
+    overlap &= (a_area[:, None] > 0) & (b_area[None, :] > 0)
+    return np.argwhere(overlap)
+
+
+def _pair_intersections(a: RLEBatch, b: RLEBatch, pairs: np.ndarray) -> np.ndarray:
+    ids, starts, lengths = a.foreground_runs()
+    first = np.searchsorted(ids, np.arange(len(a)))
+    n_runs = np.bincount(ids, minlength=len(a))
+    coverage = _Coverage(b)
+    out = np.zeros(len(pairs), dtype=np.int64)
+    queries = np.cumsum(n_runs[pairs[:, 0]])
+    chunk_start = 0
+    while chunk_start < len(pairs):
+        # Pairs whose runs fit in _MAX_QUERIES (always at least one)
+        done = queries[chunk_start - 1] if chunk_start else 0
+        chunk_end = max(
+            chunk_start + 1,
+            int(np.searchsorted(queries, done + _MAX_QUERIES, side="right")),
+        )
+        i, j = pairs[chunk_start:chunk_end].T
+        counts = n_runs[i]
+        pair = np.repeat(np.arange(len(i)), counts)
+        # Run indices of mask i for every pair, as concatenated aranges
+        offsets = np.cumsum(counts) - counts
+        runs = np.repeat(first[i] - offsets, counts) + np.arange(counts.sum())
+        x0 = starts[runs] + j[pair] * coverage.hw
+        covered = coverage(x0 + lengths[runs]) - coverage(x0)
+        out[chunk_start:chunk_end] = np.bincount(pair, weights=covered, minlength=len(i))
+        chunk_start = chunk_end
+    return out
+
+
+def intersection(a: RLEBatch, b: Optional[RLEBatch] = None) -> np.ndarray:
+    """
+    len(a) x len(b) matrix of intersection areas, len(a) x len(a) between
+    the masks of a if b is None.
+    """
+    return _intersection_and_areas(a, b)[0]
+
+
+def _intersection_and_areas(
+    a: RLEBatch, b: Optional[RLEBatch]
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    a_area, a_boxes = a.area(), a.to_box()
+    if b is None:
+        pairs = _candidates(a_boxes, a_area, a_boxes, a_area)
+        # Symmetric: compute each pair once, querying the mask with fewer
+        # runs against the other, and the diagonal is the area
+        pairs = pairs[pairs[:, 0] < pairs[:, 1]]
+        swap = a.lengths[pairs[:, 0]] > a.lengths[pairs[:, 1]]
+        pairs[swap] = pairs[swap][:, ::-1]
+        inter = np.diag(a_area)
+        values = _pair_intersections(a, a, pairs)
+        inter[pairs[:, 0], pairs[:, 1]] = values
+        inter[pairs[:, 1], pairs[:, 0]] = values
+        return inter, a_area, a_area
+    assert a.size == b.size, "Masks must have the same size."
+    b_area = b.area()
+    pairs = _candidates(a_boxes, a_area, b.to_box(), b_area)
+    inter = np.zeros((len(a), len(b)), dtype=np.int64)
+    inter[pairs[:, 0], pairs[:, 1]] = _pair_intersections(a, b, pairs)
+    return inter, a_area, b_area
+
+
+def union(a: RLEBatch, b: Optional[RLEBatch] = None) -> np.ndarray:
+    """Matrix of union areas, laid out like intersection."""
+    inter, a_area, b_area = _intersection_and_areas(a, b)
+    return a_area[:, None] + b_area[None, :] - inter
+
+
+def iou_matrix(a: RLEBatch, b: Optional[RLEBatch] = None) -> np.ndarray:
+    """Matrix of mask IoUs, laid out like intersection. Two empty masks have IoU 0."""
+    inter, a_area, b_area = _intersection_and_areas(a, b)
+    union_area = a_area[:, None] + b_area[None, :] - inter
+    return inter / np.maximum(union_area, 1)
+
+
+def mask_nms(rles: RLEBatch, scores: np.ndarray, iou_threshold: float) -> np.ndarray:
+    """
+    Greedy non-maximum suppression by mask IoU instead of box IoU: masks are
+    visited by decreasing score, and each kept mask removes the remaining
+    ones overlapping it by more than iou_threshold. Returns the indices of
+    the kept masks in decreasing score order, like torchvision's nms.
+    """
+    scores = np.asarray(scores)
+    order = np.argsort(-scores, kind="stable")
+    ious = iou_matrix(rles)
+    suppressed = np.zeros(len(rles), dtype=bool)
+    keep = []
+    for i in order:
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        suppressed |= ious[i] > iou_threshold
+    return np.array(keep, dtype=np.int64)